@@ -0,0 +1,119 @@
+import gc
+import os
+import re
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils
+from synthetic_log import synthetic_log
+
+def legacy_regular_expression(log_line):
+    #舊版：每次呼叫重新編譯三個 pattern，失敗時去除色碼再比對一次
+    color_action_pattern = re.compile(
+        r'^\[\d{2}:\d{2}:\d{2}\] \[Render thread/INFO\]: \[System\] \[CHAT\] '
+        r'(\d+\.\d+)/(h|d|m) ago §[0-9a-fk-or][+-] (\w+)§f (added|removed) x(\d+) (\w+)§f\.$'
+    )
+    plain_action_pattern = re.compile(
+        r'^\[\d{2}:\d{2}:\d{2}\] \[Render thread/INFO\]: \[System\] \[CHAT\] '
+        r'(\d+\.\d+)/(h|d|m) ago\s+[ac][+-]\s+(\w+)\s+f\s+(added|removed) x(\d+) (\w+)\s+f\.$'
+    )
+    page_pattern = re.compile(r'f(\d+)/(\d+)')
+    match = color_action_pattern.match(log_line)
+    if match:
+        _, _, username, action, count, item = match.groups()
+        return {"user": username, "action": 1 if action == "added" else -1, "item": item, "count": int(count)}
+    match = plain_action_pattern.match(re.sub(r'§.', '', log_line))
+    if match:
+        _, _, username, action, count, item = match.groups()
+        return {"user": username, "action": 1 if action == "added" else -1, "item": item, "count": int(count)}
+    match = page_pattern.search(log_line)
+    if match:
+        return (int(match.group(1)), int(match.group(2)))
+    return False
+
+def legacy_collect_trade_pages(file_lines):
+    #舊版 on_message 切分迴圈 + handle_trade_log 的頁面過濾
+    pattern_1 = re.compile(r'\(x(-?\d+)/y(-?\d+)/z(-?\d+)\)(?!/)')
+    pattern_2 = re.compile(r'\(x(-?\d+)/y(-?\d+)/z(-?\d+)/Project_Epic-plots\)')
+    current_coords = None
+    auto_detect = False
+    trade_log = {}
+    for i, line in enumerate(file_lines):
+        match_2 = pattern_2.search(line)
+        match_1 = pattern_1.search(line)
+        page_pattern = re.compile(r'f\d+/\d+')
+        if match_2:
+            current_coords = tuple(map(int, match_2.groups()))
+            auto_detect = True
+        elif match_1:
+            current_coords = tuple(map(int, match_1.groups()))
+            auto_detect = False
+        if auto_detect:
+            previous_line = file_lines[i - 1] if i > 0 else "<無法取得前一行>"
+            if not page_pattern.search(previous_line):
+                trade_log.setdefault(current_coords, []).append(previous_line)
+        elif current_coords in trade_log:
+            trade_log[current_coords].append(line)
+        elif current_coords is not None:
+            trade_log[current_coords] = []
+    if auto_detect:
+        for value in trade_log.values():
+            value.append("f1/1")
+
+    shops = {}
+    for coord, log in trade_log.items():
+        filtered = {}
+        page_data = []
+        for line in log:
+            result = legacy_regular_expression(line)
+            if isinstance(result, dict):
+                page_data.append(result)
+            elif isinstance(result, tuple) and result[0] > 0:
+                filtered[result[0]] = page_data
+                page_data = []
+        shops[coord] = filtered
+    return shops, auto_detect
+
+def aggregated_pages(result):
+    #新版各頁只保留 (玩家, 物品) 的加總數量，舊版結果以相同方式加總後比較
+    shops, auto_detect = result
+    aggregated = {}
+    for coord, pages in shops.items():
+        aggregated[coord] = {}
+        for page, actions in pages.items():
+            totals = {}
+            for action in actions:
+                totals[(action["user"], action["item"])] = totals.get((action["user"], action["item"]), 0) + action["count"] * action["action"]
+            aggregated[coord][page] = utils.page_actions(totals)
+    return aggregated, auto_detect
+
+def measure(label, function, lines):
+    #與 timeit 相同，計時期間關閉循環 GC，避免大量 dict 觸發的回收干擾比較
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        result = function(lines)
+        elapsed = time.perf_counter() - start
+    finally:
+        gc.enable()
+    print(f"{label:<8} {elapsed:8.2f}s {len(lines) / elapsed:12,.0f} lines/s")
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="比較舊版逐行正規表達式與單次掃描詞法分析的速度")
+    parser.add_argument("--lines", type=int, default=1_000_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    lines = synthetic_log(args.lines, args.seed)
+    before = measure("before", legacy_collect_trade_pages, lines)
+    after = measure("after", utils.collect_trade_pages, lines)
+    if aggregated_pages(before) != after:
+        sys.exit("❌ 新舊結果不一致")
+    print("✅ 新舊結果一致")
+
+if __name__ == "__main__":
+    main()
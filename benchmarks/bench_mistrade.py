@@ -0,0 +1,169 @@
+import gc
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import utils
+from synthetic_log import synthetic_log
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+CONTENT = "!mistrade 10 8 CXP"
+#固定的上傳時間，紀錄行推算出的交易時間每次都相同
+REFERENCE = datetime(2026, 1, 1, 12, tzinfo=timezone.utc)
+
+def stage_lex(data):
+    return [utils.regular_expression(line) for line in data["lines"]]
+
+def stage_collect(data):
+    data["shops"], data["auto_detect"] = utils.collect_trade_pages(data["lines"])
+
+def stage_ingest(data):
+    #每次寫入新的資料庫，重複執行時不會被當成重新上傳
+    with tempfile.TemporaryDirectory() as directory:
+        utils.ingest_trade_log(data["lines"], REFERENCE, os.path.join(directory, "trade_ledger.db"))
+
+def stage_ledger(data):
+    data["ledgers"] = [utils.build_trade_ledger(pages, True, "") for pages in data["shops"].values()]
+
+def stage_calculator(data):
+    return [utils.mistrade_calculator(ledger, "CXP", 10, 8) for ledger in data["ledgers"]]
+
+def stage_shops(data):
+    report = io.StringIO()
+    report.write("# 📜 交易結果 (Trade result) \n")
+    utils.run_trade_shops(CONTENT, data["shops"], data["auto_detect"], report)
+    data["message"] = report.getvalue()
+
+def stage_split(data):
+    return utils.split_log_result(data["message"])
+
+def calibration(data):
+    #固定的純 Python 工作量，用來換算純 Python 階段的相對耗時，降低機器速度與負載的影響
+    table = {}
+    for i in range(200_000):
+        table[f"user_{i % 997}"] = table.get(f"user_{i % 997}", 0) + i
+    return table
+
+def calibration_numpy(data):
+    #帳本與計算階段是逐間商店對小陣列做向量化運算，耗時主要在 NumPy 的呼叫成本，
+    #純 Python 迴圈無法反映不同機器 / NumPy 版本間的差異，改用相同形態的固定工作量換算
+    keys = np.arange(64, dtype=np.int64) % 17
+    for _ in range(2_000):
+        pair_keys, first_seen, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        totals = np.zeros(len(pair_keys), dtype=np.int64)
+        np.add.at(totals, inverse, keys)
+        np.lexsort((first_seen, pair_keys)).tolist()
+
+#依序執行，後面的階段使用前面階段的結果；各階段以工作形態相近的校準工作量換算相對耗時
+STAGES = [
+    ("lex", stage_lex, calibration),
+    ("collect", stage_collect, calibration),
+    ("ingest", stage_ingest, calibration),
+    ("ledger", stage_ledger, calibration_numpy),
+    ("calculator", stage_calculator, calibration_numpy),
+    ("shops", stage_shops, calibration),
+    ("split", stage_split, calibration),
+]
+
+def time_once(function, data):
+    #計時期間關閉循環 GC（與 timeit 相同）
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        function(data)
+        return time.perf_counter() - start
+    finally:
+        gc.enable()
+
+def time_stage(function, calibrate, data, repeat):
+    #階段與校準交替執行，兩者受到相同時段的負載影響；回傳 (最快一次的秒數, 相對耗時的中位數)
+    timings = []
+    for _ in range(repeat):
+        seconds = time_once(function, data)
+        timings.append((seconds, seconds / time_once(calibrate, data)))
+    ratios = sorted(ratio for seconds, ratio in timings)
+    return min(seconds for seconds, ratio in timings), ratios[len(ratios) // 2]
+
+def peak_memory(function, data):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function(data)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def run(line_count, seed, repeat):
+    data = {"lines": synthetic_log(line_count, seed)}
+    results = {}
+    for name, function, calibrate in STAGES:
+        seconds, relative = time_stage(function, calibrate, data, repeat)
+        results[name] = {
+            "seconds": seconds,
+            "lines_per_second": line_count / seconds,
+            "relative": relative,
+            "peak_mb": peak_memory(function, data) / 1024 / 1024
+        }
+    return results
+
+def compare(results, baseline, tolerance):
+    #相對耗時（階段時間 / 校準時間）或記憶體高於基準 (1 + tolerance) 視為退步
+    regressions = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        if result["relative"] > expected["relative"] * (1 + tolerance):
+            regressions.append(f"{name}: 相對耗時 {result['relative']:.2f} > 基準 {expected['relative']:.2f}")
+        if result["peak_mb"] > expected["peak_mb"] * (1 + tolerance):
+            regressions.append(f"{name}: 記憶體 {result['peak_mb']:.1f} MB > 基準 {expected['peak_mb']:.1f} MB")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="錯誤交易流程各階段的效能測試（離線執行）")
+    parser.add_argument("--lines", type=int, default=200_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    parser.add_argument("--update-baseline", action="store_true", help="以這次結果覆寫 baseline.json")
+    args = parser.parse_args()
+
+    #barrel_data.json / pig_vip.json 以相對路徑讀取
+    os.chdir(ROOT)
+    results = run(args.lines, args.seed, args.repeat)
+    print(f"{'stage':<12} {'seconds':>8} {'lines/s':>12} {'relative':>8} {'peak MB':>8}")
+    for name, result in results.items():
+        print(f"{name:<12} {result['seconds']:8.3f} {result['lines_per_second']:12,.0f} {result['relative']:8.2f} {result['peak_mb']:8.1f}")
+
+    baselines = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH, "r", encoding="utf-8") as f:
+            baselines = json.load(f)
+    #基準依行數分開保存，行數不同的結果無法直接比較
+    key = str(args.lines)
+    if args.update_baseline:
+        baselines[key] = results
+        with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+            json.dump(baselines, f, indent=4)
+        print(f"✅ 已更新 {args.lines} 行的基準")
+        return
+    if key not in baselines:
+        print(f"⚠️ 沒有 {args.lines} 行的基準，請以 --update-baseline 建立")
+        return
+    regressions = compare(results, baselines[key], args.tolerance)
+    if regressions:
+        sys.exit("❌ 效能退步:\n" + "\n".join(regressions))
+    print("✅ 未超出基準")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import io
+import os
+import sys
+import time
+import json
+import asyncio
+import argparse
+import discord
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import utils
+from synthetic_log import synthetic_log
+
+class FakeDiscord:
+    #本機模擬的 Discord API：計算每個頻道的呼叫次數，並依 bucket 回傳速率限制標頭與 429
+    def __init__(self, limit, period):
+        self.limit = limit
+        self.period = period
+        self.buckets = {}
+        self.calls = {}
+        self.rate_limited = 0
+        self.next_id = 1
+
+    def application(self):
+        app = web.Application()
+        app.router.add_get("/api/v10/users/@me", self.current_user)
+        app.router.add_post("/api/v10/channels/{channel_id}/messages", self.create_message)
+        return app
+
+    def json_response(self, data, status=200, headers=None):
+        #discord.py 只在 Content-Type 完全等於 application/json 時解析 JSON
+        return web.Response(body=json.dumps(data).encode("utf-8"), status=status, headers=dict(headers or {}, **{"Content-Type": "application/json"}))
+
+    def user(self):
+        return {"id": "1", "username": "bench", "discriminator": "0", "global_name": None, "avatar": None, "bot": True}
+
+    async def current_user(self, request):
+        return self.json_response(self.user())
+
+    async def create_message(self, request):
+        channel_id = request.match_info["channel_id"]
+        self.calls[channel_id] = self.calls.get(channel_id, 0) + 1
+        now = time.monotonic()
+        window_start, used = self.buckets.get(channel_id, (now, 0))
+        if now - window_start >= self.period:
+            window_start, used = now, 0
+        reset_after = self.period - (now - window_start)
+        headers = {
+            "X-RateLimit-Bucket": f"channel-{channel_id}",
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Reset": str(time.time() + reset_after),
+            "X-RateLimit-Reset-After": f"{reset_after:.3f}",
+        }
+        if used >= self.limit:
+            self.rate_limited += 1
+            headers["X-RateLimit-Remaining"] = "0"
+            headers["X-RateLimit-Scope"] = "user"
+            return self.json_response({"message": "You are being rate limited.", "retry_after": reset_after, "global": False}, status=429, headers=headers)
+        self.buckets[channel_id] = (window_start, used + 1)
+        headers["X-RateLimit-Remaining"] = str(self.limit - used - 1)
+        #附件上傳為 multipart，只需讀完內容
+        if request.content_type.startswith("multipart/"):
+            await request.post()
+        else:
+            await request.read()
+        self.next_id += 1
+        message = {
+            "id": str(self.next_id), "channel_id": channel_id, "author": self.user(), "content": "",
+            "timestamp": "2024-01-01T00:00:00+00:00", "edited_timestamp": None, "tts": False,
+            "mention_everyone": False, "mentions": [], "mention_roles": [], "attachments": [],
+            "embeds": [], "pinned": False, "type": 0
+        }
+        return self.json_response(message, headers=headers)
+
+def build_report(line_count, seed):
+    #以模擬紀錄跑完整的錯誤交易流程，產生與 !mistrade 相同的報告文字
+    shops, auto_detect = utils.collect_trade_pages(synthetic_log(line_count, seed))
+    report = io.StringIO()
+    report.write("# 📜 交易結果 (Trade result) \n")
+    utils.run_trade_shops("!mistrade 10 8 CXP", shops, auto_detect, report)
+    return report.getvalue()
+
+async def measure(label, fake, channel, deliver):
+    before = sum(fake.calls.values())
+    start = time.perf_counter()
+    await deliver(channel)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<10} {sum(fake.calls.values()) - before:6d} 次 API 呼叫 {elapsed:8.2f}s")
+
+async def run(args):
+    fake = FakeDiscord(args.limit, args.period)
+    runner = web.AppRunner(fake.application())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    discord.http.Route.BASE = f"http://127.0.0.1:{port}/api/v10"
+
+    client = discord.Client(intents=discord.Intents.none())
+    #只需要 HTTP 連線，不連 gateway
+    await client.http.static_login("fake-token")
+    try:
+        report = build_report(args.lines, args.seed)
+        print(f"報告長度 {len(report)} 字，速率限制 {args.limit} 次 / {args.period}s")
+
+        async def naive(channel):
+            for chunk in utils.split_log_result(report):
+                await channel.send(chunk)
+
+        async def queued(channel):
+            sender = utils.ChannelSender(channel)
+            stream = sender.report()
+            stream.write(report)
+            stream.finish()
+            await sender.task
+
+        await measure("逐段送出", fake, client.get_partial_messageable(1), naive)
+        await measure("送出佇列", fake, client.get_partial_messageable(2), queued)
+        print(f"收到 429 共 {fake.rate_limited} 次")
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+def main():
+    parser = argparse.ArgumentParser(description="以本機模擬的 Discord API 比較逐段送出與送出佇列的 API 呼叫次數")
+    parser.add_argument("--lines", type=int, default=3_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--limit", type=int, default=5)
+    parser.add_argument("--period", type=float, default=5.0)
+    args = parser.parse_args()
+
+    #barrel_data.json / pig_vip.json 以相對路徑讀取
+    os.chdir(ROOT)
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
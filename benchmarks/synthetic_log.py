@@ -0,0 +1,71 @@
+import os
+import ast
+import json
+import random
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHAT = "[Render thread/INFO]: [System] [CHAT] "
+USERS = ["Ian0822", "Curtis_uwu", "hoshinolover", "Sw_Fox", "Alice_1", "Bob2", "XmasTiramisu"]
+CURRENCIES = ["experience_bottle", "dragon_breath", "sunflower", "prismarine_shard", "prismarine_crystals", "nether_star", "gray_dye", "firework_star"]
+PRODUCTS = ["rare_frag", "diamond", "cobblestone", "white_wool", "iron_ingot"]
+
+def registered_barrels():
+    #使用 barrel_data.json 的登記座標，讓自動模式能對應到真實商店
+    with open(os.path.join(ROOT, "barrel_data.json"), "r", encoding="utf-8") as f:
+        return [ast.literal_eval(key) for key in json.load(f)]
+
+def action_line(rng):
+    stamp = f"[{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}] "
+    action = rng.choice(["added", "removed"])
+    sign = "+" if action == "added" else "-"
+    user = rng.choice(USERS)
+    item = rng.choice(CURRENCIES) if rng.random() < 0.6 else rng.choice(PRODUCTS)
+    count = rng.randint(1, 64)
+    age = f"{rng.randint(0, 9)}.{rng.randint(0, 9)}/{rng.choice('hdm')} ago"
+    if rng.random() < 0.7:
+        return f"{stamp}{CHAT}{age} §{rng.choice('ac')}{sign} {user}§f {action} x{count} {item}§f."
+    return f"{stamp}{CHAT}{age} a{sign} {user} f {action} x{count} {item} f."
+
+def synthetic_log(line_count, seed=0, manual_ratio=0.3, registered_ratio=0.85, noise_ratio=0.1):
+    #產生含色碼/無色碼交易、自動 (/Project_Epic-plots) / 手動座標、fN/M 頁碼與雜訊的模擬紀錄
+    #registered_ratio 為使用登記座標的比例，其中一部分會偏移一格以觸發範圍查找
+    rng = random.Random(seed)
+    barrels = registered_barrels()
+    lines = []
+    while len(lines) < line_count:
+        if rng.random() < registered_ratio:
+            x, y, z = rng.choice(barrels)
+            if rng.random() < 0.1:
+                x += rng.choice([-1, 1])
+        else:
+            x, y, z = rng.randint(-999, 999), rng.randint(0, 99), rng.randint(-999, 999)
+        manual = rng.random() < manual_ratio
+        if manual:
+            lines.append(f"[00:00:00] {CHAT}Checking (x{x}/y{y}/z{z})")
+        pages = rng.randint(1, 3)
+        for page in range(1, pages + 1):
+            for _ in range(rng.randint(3, 20)):
+                if rng.random() < noise_ratio:
+                    lines.append(f"[00:00:01] [Render thread/INFO]: Loaded {rng.randint(1, 999)} advancements")
+                else:
+                    lines.append(action_line(rng))
+            if not manual:
+                lines.append(f"[00:00:02] {CHAT}Barrel (x{x}/y{y}/z{z}/Project_Epic-plots)")
+            lines.append(f"[00:00:03] {CHAT}§7<< §f{page}/{pages} §7>>")
+    return lines[:line_count]
+
+def main():
+    parser = argparse.ArgumentParser(description="產生模擬的 Monumenta 木桶交易紀錄")
+    parser.add_argument("output")
+    parser.add_argument("--lines", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--manual-ratio", type=float, default=0.3)
+    args = parser.parse_args()
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        f.write("\n".join(synthetic_log(args.lines, args.seed, args.manual_ratio)))
+    print(f"✅ 已寫入 {args.lines} 行到 {args.output}")
+
+if __name__ == "__main__":
+    main()
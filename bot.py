@@ -1,30 +1,49 @@
 import discord
+from discord import app_commands
 from discord.ext import commands
 import os
 from dotenv import load_dotenv
-import json
 import aiohttp
+from aiohttp import web
 import asyncio
 import socket
 import re
 import random
 import logging
+import tempfile
+import time
+import io
 from mutagen.mp3 import MP3
 from mutagen.easyid3 import EasyID3
 from utils import update_item_data
-from utils import build_index
-from utils import search_items
-from utils import format_item_short
+from utils import prepare_item_data
+from utils import find_items
+from utils import complete_item_names
+from utils import query_cache_stats
+from utils import format_item_cached
+from utils import render_cache_stats
 from utils import manage_build
-from utils import split_log_result
-from utils import handle_trade_log
+from utils import build_report_attachment
+from utils import AttachmentReport
+from utils import channel_sender
+from utils import analyze_trade_shops
+from utils import ingest_trade_log
+from utils import load_upload_pages
+from utils import TRADE_LEDGER_PATH
+from utils import iter_decoded_lines
 from utils import manage_pig_vip
 from utils import mouse_click_safe
 from utils import mouse_move_safe
 from utils import screenshot_with_cursor
 from utils import parse_duration
 from utils import press_key_safe
-from collections import defaultdict
+from utils import measure
+from utils import timed
+from utils import render_metrics
+from utils import start_profiling
+from utils import collect_profile
+from utils import render_profile_report
+from collections import Counter, defaultdict, OrderedDict, deque
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
@@ -82,22 +101,220 @@ ALLOWED_KEYS = {
     "f1","f2","f3","f4","f5","f6","f7","f8","f9","f10","f11","f12"
 }
 MAX_DURATION = 10
+MISTRADE_CHUNK_SIZE = 64 * 1024
+MISTRADE_SPOOL_SIZE = 1024 * 1024
 control_lock = asyncio.Lock()
 
+update_lock = asyncio.Lock()
+
 def load_and_index_data():
     global item_data, search_index
-    with open(ITEM_DATA_PATH, "r", encoding="utf-8") as f:
-        item_data = json.load(f)
-    search_index = build_index(item_data)
+    item_data, search_index, changes = prepare_item_data(ITEM_DATA_PATH)
     print("📦 物品資料載入完成，共載入", len(item_data), "筆資料")
 
+async def reload_item_data():
+    #在背景執行緒比對新舊資料並修補索引，完成後一次替換，期間查詢仍使用舊索引
+    global item_data, search_index
+    new_data, new_index, changes = await asyncio.to_thread(prepare_item_data, ITEM_DATA_PATH, (item_data, search_index))
+    item_data, search_index = new_data, new_index
+    print("📦 物品資料載入完成，共載入", len(item_data), "筆資料，變動:", changes)
+    return changes
+
+
+def build_find_reply(itemsToFind):
+    #條件查詢 / 完全符合依相關度排序 / 容錯搜尋，結果由 find_items 快取
+    top_results, total, mode = find_items(itemsToFind, search_index)
+    if not top_results:
+        return "<:ghost_technology_4:1293185676086481039> 找不到符合物品。"
+
+    msg_lines = []
+    if mode == "fuzzy":
+        msg_lines.append("<:ghost_technology_4:1293185676086481039> 找不到完全符合的物品，以下為最相近的結果：")
+
+    for item in top_results:
+        msg_lines.append( "\n ----------------------------------"  + "\n" + format_item_cached(item, search_index))
+
+    if total > 5:
+        msg_lines.append(f"...以及其他 {total-5} 筆結果，請嘗試更精確的關鍵字。")
+
+    return "\n".join(msg_lines)
+
+# ----------------- 錯誤交易工作佇列 -----------------
+MISTRADE_JOB_WORKERS = int(os.getenv("MISTRADE_JOB_WORKERS", 2))
+MISTRADE_PROGRESS_INTERVAL = 1.5
+#結果超過約 4 則訊息時改為摘要 + 附件
+MISTRADE_ATTACHMENT_THRESHOLD = 4 * 2000
+#每位使用者各自一條佇列，取出工作後該使用者排到最後，依使用者輪流處理
+mistrade_queues = OrderedDict()
+mistrade_active = []
+mistrade_condition = asyncio.Condition()
+mistrade_workers = []
+
+def next_mistrade_job():
+    user, queue = next(iter(mistrade_queues.items()))
+    job = queue.popleft()
+    if queue:
+        mistrade_queues.move_to_end(user)
+    else:
+        del mistrade_queues[user]
+    return job
+
+def mistrade_queue_position(user):
+    #使用者最新一筆工作的順位：排在前面的使用者各多輪到一次
+    rank = len(mistrade_queues[user]) - 1
+    turn = list(mistrade_queues).index(user)
+    return 1 + sum(min(len(queue), rank + (i < turn)) for i, queue in enumerate(mistrade_queues.values()))
+
+async def enqueue_mistrade(message):
+    if not mistrade_workers:
+        mistrade_workers.extend(asyncio.create_task(mistrade_worker()) for _ in range(MISTRADE_JOB_WORKERS))
+    async with mistrade_condition:
+        mistrade_queues.setdefault(message.author.id, deque()).append({"message": message, "user": message.author.id, "task": None})
+        mistrade_condition.notify()
+        return mistrade_queue_position(message.author.id)
+
+def cancel_mistrade(user):
+    #移除排隊中的工作並取消執行中的工作，回傳取消數量
+    queued = mistrade_queues.pop(user, ())
+    running = [job for job in mistrade_active if job["user"] == user]
+    for job in running:
+        job["task"].cancel()
+    return len(queued) + len(running)
+
+async def mistrade_worker():
+    while True:
+        async with mistrade_condition:
+            await mistrade_condition.wait_for(lambda: mistrade_queues)
+            job = next_mistrade_job()
+        job["task"] = asyncio.create_task(run_mistrade_job(job["message"]))
+        mistrade_active.append(job)
+        try:
+            await asyncio.wait([job["task"]])
+        finally:
+            mistrade_active.remove(job)
+        if not job["task"].cancelled() and job["task"].exception():
+            logger.error("錯誤交易分析失敗", exc_info=job["task"].exception())
+            await job["message"].reply("<:ghost_technology_4:1293185676086481039> 分析時發生錯誤。")
+
+@timed("mistrade", "job")
+async def run_mistrade_job(message):
+    #!mistrade all ... 以帳本保留期限內的累計數量計算，預設只計算這次上傳中先前未處理過的交易
+    cumulative = message.content.split()[1:2] == ["all"]
+    originMessage = ""
+    # 1. 檢查附件：分塊下載到暫存檔（小檔留在記憶體），再於背景執行緒逐行解析並寫入交易帳本
+    if message.attachments:
+        attachment = message.attachments[0]
+        if attachment.filename.endswith('.txt'):
+            with tempfile.SpooledTemporaryFile(max_size=MISTRADE_SPOOL_SIZE) as spool:
+                async with aiohttp.ClientSession() as session:
+                    async with session.get(attachment.url) as resp:
+                        if resp.status == 200:
+                            downloaded = 0
+                            async for chunk in resp.content.iter_chunked(MISTRADE_CHUNK_SIZE):
+                                downloaded += len(chunk)
+                                #超過 MISTRADE_SPOOL_SIZE 後暫存檔會寫到磁碟，改在背景執行緒寫入，不阻塞事件迴圈
+                                if downloaded > MISTRADE_SPOOL_SIZE:
+                                    await asyncio.to_thread(spool.write, chunk)
+                                else:
+                                    spool.write(chunk)
+                            originMessage = "DONE"
+                if originMessage:
+                    spool.seek(0)
+                    chunks = iter(lambda: spool.read(MISTRADE_CHUNK_SIZE), b"")
+                    upload, ledger_stats, auto_detect = await asyncio.to_thread(ingest_trade_log, iter_decoded_lines(chunks), message.created_at, TRADE_LEDGER_PATH)
+
+    # 2. 沒有附件的情況：取 !mistrade 後面的文字
+    else:
+        originMessage = message.content[len("!mistrade "):].strip()
+        if cumulative:
+            originMessage = originMessage[len("all"):].strip()
+        if originMessage:
+            upload, ledger_stats, auto_detect = await asyncio.to_thread(ingest_trade_log, [originMessage], message.created_at, TRADE_LEDGER_PATH)
+
+    if not originMessage:
+        await message.reply("<:ghost_technology_4:1293185676086481039> 請提供有效的內容或 .txt 附件。")
+        return
+
+    # 3. 處理交易紀錄
+    #寫入帳本時已依交易時間去重，只分析這次上傳中先前未處理過的交易（各頁依 (玩家, 物品) 加總）
+    added = sum(stat[1] for stat in ledger_stats.values())
+    skipped = sum(stat[2] for stat in ledger_stats.values())
+    trade_pages = await asyncio.to_thread(load_upload_pages, upload, {coord: stat[0] for coord, stat in ledger_stats.items()}, TRADE_LEDGER_PATH)
 
-load_and_index_data()
+    #各商店在工作程序中平行計算，依座標順序合併；同一則進度訊息隨商店完成更新
+    progress_message = await message.channel.send(f"⏳ 新增 {added} 筆交易紀錄，略過 {skipped} 筆已處理的紀錄，正在分析 {len(trade_pages)} 間商店...") if trade_pages else None
+    last_update = time.monotonic()
+
+    async def report_progress(done, total):
+        nonlocal last_update
+        if done < total and time.monotonic() - last_update < MISTRADE_PROGRESS_INTERVAL:
+            return
+        last_update = time.monotonic()
+        try:
+            await progress_message.edit(content=f"{'✅' if done == total else '⏳'} 商店分析進度：{done}/{total}")
+        except discord.HTTPException:
+            pass
+
+    #各段商店完成後依座標順序寫入報告，頻道送出佇列每湊滿一段就先送出
+    #結果過長時只逐段送出前 MISTRADE_ATTACHMENT_THRESHOLD 字，其餘改為一則摘要並附上完整的 Markdown 報告，避免大量訊息觸發速率限制
+    sender = channel_sender(message.channel)
+    report = AttachmentReport(sender.report(), MISTRADE_ATTACHMENT_THRESHOLD)
+    report.write(f"# 📜 交易結果 (Trade result) \n")
+    await analyze_trade_shops(message.content, trade_pages, auto_detect, report, report_progress, TRADE_LEDGER_PATH if cumulative else None)
+    if not report.overflowed():
+        report.stream.finish()
+        return
+
+    full_report = report.text()
+    #每位交易錯誤的玩家在報告中以 :warning: 標示
+    summary = (
+        f"# 📜 交易結果 (Trade result) \n"
+        f"已分析 {len(trade_pages)} 間商店，共 {full_report.count(':warning:')} 位玩家交易錯誤 (mistraded players)。\n"
+        f"完整結果共 {report.length} 字，請見附件。"
+    )
+    sender.enqueue(summary, file=discord.File(build_report_attachment(full_report), filename=f"mistrade_{message.id}.md"))
+
+# ----------------- 效能指標端點 -----------------
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+metrics_runner = None
+
+async def metrics_endpoint(request):
+    return web.Response(body=render_metrics(command_counts).encode("utf-8"), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+async def start_metrics_server():
+    #與 bot 共用事件迴圈，只監聽本機；METRICS_PORT=0 時不啟動
+    global metrics_runner
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_endpoint)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError:
+        await runner.cleanup()
+        raise
+    metrics_runner = runner
+    print(f"📈 效能指標：http://{METRICS_HOST}:{METRICS_PORT}/metrics")
 
 # ----------------- 主程式 -----------------
+commands_synced = False
+
 @bot.event
 async def on_ready():
+    global commands_synced
     print(f'🤖 機器人已登入：{bot.user}')
+    if not commands_synced:
+        try:
+            await bot.tree.sync()
+            commands_synced = True
+        except discord.HTTPException as e:
+            print(f"⚠️ 無法同步斜線指令：{e}")
+    if metrics_runner is None and METRICS_PORT:
+        try:
+            await start_metrics_server()
+        except OSError as e:
+            print(f"⚠️ 無法啟動效能指標端點：{e}")
     try:
         user = await bot.fetch_user(ADMIN_IDS[0])
         await user.send(f"🟢 Bot 啟動於：{socket.gethostname()} | PID: {os.getpid()}")
@@ -139,259 +356,277 @@ async def on_member_join(member):
         else:
             print("找不到指定的身分組！")
 
+# ----------------- 指令路由 -----------------
+#指令名稱 → 處理函式，on_message 只查一次表，耗時與指令數量無關
+message_commands = {}
+command_counts = Counter()
+COMMAND_PATTERN = re.compile(r"\S*")
+
+def message_command(name):
+    #處理函式的延遲 / 進行中數量 / 錯誤數記錄在 bot_latency_seconds{kind="command"}
+    def register(handler):
+        message_commands[name] = timed(name, "command")(handler)
+        return handler
+    return register
+
 @bot.event
 async def on_message(message):
     if message.author == bot.user:
         return
+    #一般聊天訊息沒有前綴，直接略過
+    if not message.content.startswith(PREFIX):
+        return
+    #只比對前綴後的第一個詞，不切割整則訊息（錯誤交易紀錄可能很長）
+    name = COMMAND_PATTERN.match(message.content, len(PREFIX)).group()
+    handler = message_commands.get(name)
+    if handler is not None:
+        command_counts[name] += 1
+        await handler(message)
+    elif name in bot.all_commands:
+        #join / leave / play 等 commands.Bot 指令
+        command_counts[name] += 1
+        with measure(name, "command"):
+            await bot.process_commands(message)
+    else:
+        command_counts["unknown"] += 1
+
+# ----------------- 查詢指令 -----------------
+@message_command("find")
+async def handle_find(message):
+    itemsToFind = message.content[len(f"{PREFIX}find"):].strip()
+    if not itemsToFind:
+        await message.channel.send("<:ghost_technology_4:1293185676086481039> 請提供要查詢的名稱。")
+        return
+    #搜尋提示與結果屬於同一份回覆，可以合併送出
+    report = channel_sender(message.channel).report()
+    report.write('🔍 正在搜尋 ' + str(itemsToFind) + "...\n")
+    report.write(build_find_reply(itemsToFind))
+    report.finish()
+
+# ----------------- 尋找錯誤交易 -----------------
+@message_command("mistrade")
+async def handle_mistrade(message):
+    if message.content.split()[1:2] == ["cancel"]:
+        cancelled = cancel_mistrade(message.author.id)
+        if cancelled:
+            await message.reply(f"🛑 已取消 {cancelled} 個錯誤交易分析工作。")
+        else:
+            await message.reply("<:ghost_technology_4:1293185676086481039> 沒有可取消的工作。")
+        return
+    position = await enqueue_mistrade(message)
+    await message.reply(f"📥 已加入分析佇列，目前排在第 {position} 位。")
+
+# ----------------- Menta職業建構者 -----------------
+@message_command("build")
+async def handle_build(message):
+    buildCommand = [word for word in message.content.split()]
+    if len(buildCommand) >= 2:
+        report = channel_sender(message.channel).report()
+        manage_build(buildCommand, message.author.name, report)
+        report.finish()
+    else:
+        await message.channel.send('<:ghost_technology_4:1293185676086481039> 格式錯誤')
 
-    # ----------------- 查詢指令 -----------------
-    if message.content.startswith(f'{PREFIX}find '):
-        itemsToFind = message.content[len(f"{PREFIX}find"):].strip()
-        if not itemsToFind:
-            await message.channel.send("<:ghost_technology_4:1293185676086481039> 請提供要查詢的名稱。")
-            return
-        await message.channel.send('🔍 正在搜尋 ' + str(itemsToFind) + "...")
-
-        results = search_items(itemsToFind, search_index)
+# ----------------- 管理員功能 -----------------
+@message_command("updateAPI")
+async def handle_update_api(message):
+    username = message.author.name
 
-        if not results:
-            await message.channel.send("<:ghost_technology_4:1293185676086481039> 找不到符合物品。")
-            return
-        
-        msg_lines = []
-        for item in results[:5]:
-            msg_lines.append( "\n ----------------------------------"  + "\n" + format_item_short(item))
-
-        if len(results) > 5:
-            msg_lines.append(f"...以及其他 {len(results)-5} 筆結果，請嘗試更精確的關鍵字。")
-
-        await message.channel.send("\n".join(msg_lines))
-
-    # ----------------- 尋找錯誤交易 -----------------
-    if message.content.startswith(f'{PREFIX}mistrade'):
-        file_lines = []
-        # 1. 檢查附件
-        if message.attachments:
-            attachment = message.attachments[0]
-            if attachment.filename.endswith('.txt'):
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(attachment.url) as resp:
-                        if resp.status == 200:
-                            data = await resp.read()
-                            text = data.decode('utf-8')
-                            file_lines = text.splitlines()
-                            originMessage = "DONE"
-        
-        # 2. 沒有附件的情況：取 !mistrade 後面的文字
-        else:
-            originMessage = message.content[len("!mistrade "):].strip()
-            file_lines.append(originMessage)
-        
-        if not originMessage:
-            await message.reply("<:ghost_technology_4:1293185676086481039> 請提供有效的內容或 .txt 附件。")
-            return
+    if username not in BOT_ADMIN:
+        await message.channel.send(f"⛔ {username} 沒有權限更新資料。")
+        return
 
-        # 3. 處理交易紀錄
-        pattern_1 = re.compile(r'\(x(-?\d+)/y(-?\d+)/z(-?\d+)\)(?!/)')
-        pattern_2 = re.compile(r'\(x(-?\d+)/y(-?\d+)/z(-?\d+)/Project_Epic-plots\)')
-
-        current_coords = None
-        auto_detect = False
-        trade_log = {}
-
-        for i, line in enumerate(file_lines):
-            match_2 = pattern_2.search(line)
-            match_1 = pattern_1.search(line)
-            page_pattern = re.compile(r'f\d+/\d+')
-            #自動
-            if match_2:
-                x, y, z = map(int, match_2.groups())
-                current_coords = (x, y, z)
-                auto_detect = True
-
-            #手動
-            elif match_1:
-                x, y, z = map(int, match_1.groups())
-                current_coords = (x, y, z)
-                auto_detect = False
-        
-            if auto_detect:
-                previous_line = file_lines[i - 1] if i > 0 else "<無法取得前一行>"
-                if not page_pattern.search(previous_line):
-                    if current_coords in trade_log:
-                        trade_log[current_coords].append(previous_line)
-                    elif current_coords != None:
-                        trade_log[current_coords] = [previous_line]
-        
-            elif not auto_detect:
-                if current_coords in trade_log:
-                    trade_log[current_coords].append(line)
-                elif current_coords != None:
-                    trade_log[current_coords] = []
-
-        if auto_detect:
-            for key, value in trade_log.items():
-                value.append("f1/1")
-        
-        fianl_message = f"# 📜 交易結果 (Trade result) \n"
-
-        for coord, log in trade_log.items():
-            result = handle_trade_log(message.content, log, coord, auto_detect)
-            fianl_message += result[0]
-            auto_detect = result[1]
-        
-        for log_line in split_log_result(fianl_message):
-            await message.channel.send(log_line)
-
-    # ----------------- Menta職業建構者 -----------------
-    if message.content.startswith(f'{PREFIX}build'):
-        buildCommand = [word for word in message.content.split()]
-        if len(buildCommand) >= 2:
-            result = manage_build(buildCommand, message.author.name)
-            for line in split_log_result(result):
-                await message.channel.send(line)
-        else:
-            await message.channel.send('<:ghost_technology_4:1293185676086481039> 格式錯誤')
-            
-    # ----------------- 管理員功能 -----------------
-    if message.content.startswith(f"{PREFIX}updateAPI"):
-        username = message.author.name
-
-        if username not in BOT_ADMIN:
-            await message.channel.send(f"⛔ {username} 沒有權限更新資料。")
-            return
+    if update_lock.locked():
+        await message.channel.send("⏳ 道具資料正在更新中，請稍候。")
+        return
 
+    async with update_lock:
         await message.channel.send(f"🔄 開始更新道具資料...")
 
-        success = update_item_data()
+        success = await update_item_data(ITEM_DATA_PATH)
         if success:
-            load_and_index_data()
-            await message.channel.send("✅ 成功更新道具資料！")
+            changes = await reload_item_data()
+            await message.channel.send(
+                f"✅ 成功更新道具資料！新增 {changes['added']} 筆、變更 {changes['changed']} 筆、移除 {changes['removed']} 筆。"
+            )
+        elif success is None:
+            await message.channel.send("✅ 道具資料已是最新版本，無需更新。")
         else:
             await message.channel.send("<:ghost_technology_4:1293185676086481039> 更新失敗，請稍後再試。")
-    
-    if message.content.startswith(f"{PREFIX}pig"):
-        username = message.author.name
 
-        if username not in BOT_ADMIN:
-            await message.channel.send(f"⛔ {username} 沒有權限更新資料。")
+@message_command("cache")
+async def handle_cache(message):
+    username = message.author.name
+
+    if username not in BOT_ADMIN:
+        await message.channel.send(f"⛔ {username} 沒有權限查看快取。")
+        return
+
+    counts = "、".join(f"{name} {count}" for name, count in command_counts.most_common()) or "無"
+    await message.channel.send(render_cache_stats(search_index) + "\n" + query_cache_stats() + f"\n📊 指令次數：{counts}")
+
+@message_command("profile")
+async def handle_profile(message):
+    username = message.author.name
+
+    if username not in BOT_ADMIN:
+        await message.channel.send(f"⛔ {username} 沒有權限執行分析。")
+        return
+
+    action = message.content.split()[1:2]
+    if action == ["start"]:
+        if start_profiling():
+            await message.channel.send("🔬 已開始分析 (cProfile + tracemalloc)，使用 `!profile dump` 取得目前報告，`!profile stop` 停止。")
+        else:
+            await message.channel.send("⚠️ 分析已在進行中。")
+    elif action in (["stop"], ["dump"]):
+        stop = action == ["stop"]
+        if not collect_profile(stop):
+            await message.channel.send("⚠️ 尚未開始分析。")
             return
+        report = await asyncio.to_thread(render_profile_report)
+        await message.channel.send(
+            f"{'🛑 已停止分析' if stop else '📄 分析進行中'}，報告請見附件。",
+            file=discord.File(io.BytesIO(report.encode("utf-8")), filename=f"profile_{int(time.time())}.txt")
+        )
+    else:
+        await message.channel.send("❌ 指令格式：`!profile start|stop|dump`")
+
+@message_command("pig")
+async def handle_pig(message):
+    username = message.author.name
+
+    if username not in BOT_ADMIN:
+        await message.channel.send(f"⛔ {username} 沒有權限更新資料。")
+        return
 
-        pig_vip_command = message.content.split()
+    pig_vip_command = message.content.split()
 
-        if len(pig_vip_command) >= 3:
-            result = manage_pig_vip(pig_vip_command[1], pig_vip_command[2])
-            await message.channel.send(result)
-        
-        elif len(pig_vip_command) == 2:
-            if pig_vip_command[1] == "list":
-                result = manage_pig_vip("list")
-            elif pig_vip_command[1] in ["add", "remove"]:
-                result = "❌ 請提供玩家ID!"
-            await message.channel.send(result)
+    if len(pig_vip_command) >= 3:
+        result = manage_pig_vip(pig_vip_command[1], pig_vip_command[2])
+        await message.channel.send(result)
 
+    elif len(pig_vip_command) == 2:
+        if pig_vip_command[1] == "list":
+            result = manage_pig_vip("list")
+        elif pig_vip_command[1] in ["add", "remove"]:
+            result = "❌ 請提供玩家ID!"
+        await message.channel.send(result)
+
+@message_command("k")
+async def handle_key(message):
     content = message.content.strip()
-    
-    if content.startswith(f"{PREFIX}k"):
-        user_id_str = str(message.author.id)
-        username = message.author.name
+    user_id_str = str(message.author.id)
+    username = message.author.name
 
-        if user_id_str not in ADMIN_IDS:
-            await message.channel.send(f"⛔ {username} 沒有權限執行操作。")
-            return
+    if user_id_str not in ADMIN_IDS:
+        await message.channel.send(f"⛔ {username} 沒有權限執行操作。")
+        return
 
-        # 切分參數
-        parts = content.split()
-        # parts[0] == "!k"
-        if len(parts) < 2:
-            await message.channel.send("❌ 指令格式：`!k <key> [duration]`")
-            return
+    # 切分參數
+    parts = content.split()
+    # parts[0] == "!k"
+    if len(parts) < 2:
+        await message.channel.send("❌ 指令格式：`!k <key> [duration]`")
+        return
 
-        key_arg = parts[1].lower()
-        duration_arg = parts[2] if len(parts) >= 3 else "0"
+    key_arg = parts[1].lower()
+    duration_arg = parts[2] if len(parts) >= 3 else "0"
 
-        # 驗證 key
-        if key_arg not in ALLOWED_KEYS:
-            await message.channel.send(f"❌ 按鍵 `{key_arg}` 未被允許。")
-            return
+    # 驗證 key
+    if key_arg not in ALLOWED_KEYS:
+        await message.channel.send(f"❌ 按鍵 `{key_arg}` 未被允許。")
+        return
 
-        # 解析 duration
-        try:
-            duration = parse_duration(duration_arg)
-        except ValueError:
-            await message.channel.send("❌ 錯誤的 duration（例如: 2, 2s 或 500ms）。")
-            return
+    # 解析 duration
+    try:
+        duration = parse_duration(duration_arg)
+    except ValueError:
+        await message.channel.send("❌ 錯誤的 duration（例如: 2, 2s 或 500ms）。")
+        return
 
-        # enforce bounds
-        if duration < 0:
-            await message.channel.send("❌ duration 不能為負數。")
-            return
-        if duration > MAX_DURATION:
-            await message.channel.send(f"❌ duration 超過最大限制 {MAX_DURATION} 秒。")
+    # enforce bounds
+    if duration < 0:
+        await message.channel.send("❌ duration 不能為負數。")
+        return
+    if duration > MAX_DURATION:
+        await message.channel.send(f"❌ duration 超過最大限制 {MAX_DURATION} 秒。")
+        return
+
+    # 取得鎖並執行（避免併發）
+    async with control_lock:
+        await message.channel.send(f"⏳ 執行中:按下 `{key_arg}` 持續 {duration} 秒 ...")
+        try:
+            await press_key_safe(key_arg, duration)
+        except Exception as e:
+            logger.exception("press_key 失敗")
+            await message.channel.send(f"❌ 執行失敗：{e}")
             return
 
-        # 取得鎖並執行（避免併發）
-        async with control_lock:
-            await message.channel.send(f"⏳ 執行中:按下 `{key_arg}` 持續 {duration} 秒 ...")
+        # 截圖並上傳（上傳完刪除檔案）
+        try:
+            path = await asyncio.to_thread(screenshot_with_cursor)
+            file = discord.File(path)
+            await message.channel.send("✅ 執行完畢", file=file)
+        except Exception as e:
+            logger.exception("截圖或上傳失敗")
+            await message.channel.send(f"⚠️ 無法截圖或上傳：{e}")
+        finally:
+            # 清除檔案
             try:
-                await press_key_safe(key_arg, duration)
-            except Exception as e:
-                logger.exception("press_key 失敗")
-                await message.channel.send(f"❌ 執行失敗：{e}")
-                return
+                if 'path' in locals() and os.path.exists(path):
+                    os.remove(path)
+            except Exception:
+                logger.exception("刪除截圖失敗")
 
-            # 截圖並上傳（上傳完刪除檔案）
-            try:
-                path = await asyncio.to_thread(screenshot_with_cursor)
-                file = discord.File(path)
-                await message.channel.send("✅ 執行完畢", file=file)
-            except Exception as e:
-                logger.exception("截圖或上傳失敗")
-                await message.channel.send(f"⚠️ 無法截圖或上傳：{e}")
-            finally:
-                # 清除檔案
-                try:
-                    if 'path' in locals() and os.path.exists(path):
-                        os.remove(path)
-                except Exception:
-                    logger.exception("刪除截圖失敗")
-
-    if content.startswith(f"{PREFIX}m") and "mistrade" not in content:
-        user_id_str = str(message.author.id)
-        username = message.author.name
-
-        if user_id_str not in ADMIN_IDS:
-            await message.channel.send(f"⛔ {username} 沒有權限執行操作。")
-            return
-        parts = content.split()
-        async with control_lock:
-            try:
-                if len(parts) == 3 and parts[1].isdigit() and parts[2].isdigit():
-                    # 移動滑鼠
-                    x, y = int(parts[1]), int(parts[2])
-                    await mouse_move_safe(x, y)
-                    info_msg = f"滑鼠已移動到 ({x}, {y})"
-                elif len(parts) == 3 and parts[1].lower() in ("l","r"):
-                    # 按滑鼠鍵
-                    button = "left" if parts[1].lower() == "l" else "right"
-                    duration = parse_duration(parts[2])
-                    if duration < 0 or duration > MAX_DURATION:
-                        await message.channel.send(f"❌ duration 必須在 0~{MAX_DURATION} 秒")
-                        return
-                    await mouse_click_safe(button, duration)
-                    info_msg = f"{button} 鍵已按下 {duration} 秒"
-                else:
-                    await message.channel.send("❌ 指令格式錯誤。範例：\n`!m x y`\n`!m l 1`")
+@message_command("m")
+async def handle_mouse(message):
+    content = message.content.strip()
+    user_id_str = str(message.author.id)
+    username = message.author.name
+
+    if user_id_str not in ADMIN_IDS:
+        await message.channel.send(f"⛔ {username} 沒有權限執行操作。")
+        return
+    parts = content.split()
+    async with control_lock:
+        try:
+            if len(parts) == 3 and parts[1].isdigit() and parts[2].isdigit():
+                # 移動滑鼠
+                x, y = int(parts[1]), int(parts[2])
+                await mouse_move_safe(x, y)
+                info_msg = f"滑鼠已移動到 ({x}, {y})"
+            elif len(parts) == 3 and parts[1].lower() in ("l","r"):
+                # 按滑鼠鍵
+                button = "left" if parts[1].lower() == "l" else "right"
+                duration = parse_duration(parts[2])
+                if duration < 0 or duration > MAX_DURATION:
+                    await message.channel.send(f"❌ duration 必須在 0~{MAX_DURATION} 秒")
                     return
+                await mouse_click_safe(button, duration)
+                info_msg = f"{button} 鍵已按下 {duration} 秒"
+            else:
+                await message.channel.send("❌ 指令格式錯誤。範例：\n`!m x y`\n`!m l 1`")
+                return
 
-                # 截圖並上傳
-                path = screenshot_with_cursor()
-                await message.channel.send(info_msg, file=discord.File(path))
-                os.remove(path)
-            except Exception as e:
-                await message.channel.send(f"❌ 執行錯誤：{e}")
-    
-    await bot.process_commands(message)
+            # 截圖並上傳
+            path = screenshot_with_cursor()
+            await message.channel.send(info_msg, file=discord.File(path))
+            os.remove(path)
+        except Exception as e:
+            await message.channel.send(f"❌ 執行錯誤：{e}")
+
+@timed("find_autocomplete", "command")
+async def find_autocomplete(interaction: discord.Interaction, current: str):
+    #每次按鍵都會觸發，只用排序名稱陣列做前綴查找
+    return [app_commands.Choice(name=name, value=name) for name in complete_item_names(current, search_index, 25)]
+
+@bot.tree.command(name="find", description="搜尋特定物品")
+@app_commands.describe(name="物品名稱或查詢條件")
+@app_commands.autocomplete(name=find_autocomplete)
+@timed("slash_find", "command")
+async def slash_find(interaction: discord.Interaction, name: str):
+    await interaction.response.send_message(build_find_reply(name))
 
 @bot.command()
 async def join(ctx):
@@ -514,4 +749,7 @@ async def changenick(ctx, *, new_nick):
 async def on_command_error(ctx, error):
     pass
 
-bot.run(TOKEN)
\ No newline at end of file
+#工作程序以 spawn 啟動時會重新匯入主程式，不可在匯入時啟動 bot
+if __name__ == "__main__":
+    load_and_index_data()
+    bot.run(TOKEN)
\ No newline at end of file
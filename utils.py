@@ -1,55 +1,805 @@
 import json
 import os
-import requests
+import aiohttp
 import re
 import os
 import ast
 import emoji
 import pyautogui, time
 import asyncio
+import operator
+import sys
+import glob
+import hashlib
+import pickle
+import sqlite3
+import bisect
+import threading
+import multiprocessing
+import functools
+import inspect
+import cProfile
+import pstats
+import tracemalloc
+import codecs
+import io
+import numpy as np
+import discord
+from array import array
+from datetime import datetime, timedelta, timezone
+from collections import OrderedDict, deque
+from contextlib import closing, contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, BrokenExecutor
 from PIL import Image, ImageDraw
 from urllib.parse import urlparse, parse_qs
 from dotenv import load_dotenv
 load_dotenv()
 BOT_PREFIX = os.getenv("BOT_PREFIX")
 
-
-def update_item_data():
-    url = "https://api.playmonumenta.com/items"
+# ----------------- 效能指標 -----------------
+#延遲直方圖的上限（秒），以 Prometheus text format 匯出
+METRIC_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+#(種類, 名稱) → 直方圖 / 進行中數量 / 錯誤數；部分函式在背景執行緒執行，更新時加鎖
+latency_metrics = {}
+metrics_lock = threading.Lock()
+
+def metric_entry(kind, name):
+    entry = latency_metrics.get((kind, name))
+    if entry is None:
+        with metrics_lock:
+            entry = latency_metrics.setdefault((kind, name), {"buckets": [0] * (len(METRIC_BUCKETS) + 1), "sum": 0.0, "count": 0, "in_flight": 0, "errors": 0})
+    return entry
+
+@contextmanager
+def measure(name, kind="function"):
+    #同步與 async 程式碼皆可使用：with measure("find", "command"): ...
+    entry = metric_entry(kind, name)
+    with metrics_lock:
+        entry["in_flight"] += 1
+    failed = False
+    start = time.perf_counter()
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-
-        with open("item_data.json", "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        yield
+    except Exception:
+        failed = True
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        with metrics_lock:
+            entry["in_flight"] -= 1
+        record_latency(name, elapsed, failed, kind)
+
+def record_latency(name, elapsed, failed=False, kind="function"):
+    #記錄已量好的耗時，例如工作程序隨結果一起傳回的時間
+    entry = metric_entry(kind, name)
+    with metrics_lock:
+        entry["buckets"][bisect.bisect_left(METRIC_BUCKETS, elapsed)] += 1
+        entry["sum"] += elapsed
+        entry["count"] += 1
+        entry["errors"] += failed
+
+def timed(name, kind="function"):
+    #在 ProcessPoolExecutor 工作程序內的呼叫不會記錄到主程序，需要把耗時傳回後以 record_latency 記錄
+    def decorate(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with measure(name, kind):
+                    return await function(*args, **kwargs)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with measure(name, kind):
+                    return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def render_metrics(command_counts=None):
+    with metrics_lock:
+        snapshot = [(kind, name, dict(entry, buckets=list(entry["buckets"]))) for (kind, name), entry in sorted(latency_metrics.items())]
+    lines = [
+        "# HELP bot_latency_seconds Latency of bot commands, jobs and hot functions.",
+        "# TYPE bot_latency_seconds histogram"
+    ]
+    for kind, name, entry in snapshot:
+        labels = f'kind="{kind}",name="{name}"'
+        cumulative = 0
+        for bound, count in zip(METRIC_BUCKETS + ("+Inf",), entry["buckets"]):
+            cumulative += count
+            lines.append(f'bot_latency_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f"bot_latency_seconds_sum{{{labels}}} {entry['sum']}")
+        lines.append(f"bot_latency_seconds_count{{{labels}}} {entry['count']}")
+    lines += ["# HELP bot_in_flight Calls currently running.", "# TYPE bot_in_flight gauge"]
+    lines += [f'bot_in_flight{{kind="{kind}",name="{name}"}} {entry["in_flight"]}' for kind, name, entry in snapshot]
+    lines += ["# HELP bot_errors_total Calls that raised an exception.", "# TYPE bot_errors_total counter"]
+    lines += [f'bot_errors_total{{kind="{kind}",name="{name}"}} {entry["errors"]}' for kind, name, entry in snapshot]
+    if command_counts is not None:
+        lines += ["# HELP bot_commands_total Prefixed messages received per command.", "# TYPE bot_commands_total counter"]
+        lines += [f'bot_commands_total{{command="{name}"}} {count}' for name, count in sorted(command_counts.items())]
+    return "\n".join(lines) + "\n"
+
+# ----------------- 執行期分析 -----------------
+#只在 !profile start 到 stop 之間掛上 cProfile / tracemalloc，平時沒有任何額外負擔
+PROFILE_TOP = 40
+PROFILE_TRACE_FRAMES = 5
+profiling_state = {"profiler": None, "started": None, "owns_tracemalloc": False, "stats": None, "snapshot": None, "elapsed": 0.0}
+
+def start_profiling():
+    if profiling_state["profiler"] is not None:
+        return False
+    #已由 PYTHONTRACEMALLOC 等方式啟動時沿用，停止時也不關閉
+    profiling_state["owns_tracemalloc"] = not tracemalloc.is_tracing()
+    if profiling_state["owns_tracemalloc"]:
+        tracemalloc.start(PROFILE_TRACE_FRAMES)
+    profiler = cProfile.Profile()
+    profiling_state.update(profiler=profiler, started=time.perf_counter(), stats=None, snapshot=None, elapsed=0.0)
+    profiler.enable()
+    return True
+
+def collect_profile(stop):
+    #cProfile 只分析啟動它的執行緒，必須在事件迴圈中呼叫；stop=False 時取完資料繼續分析
+    profiler = profiling_state["profiler"]
+    if profiler is not None:
+        profiler.disable()
+        profiling_state["stats"] = pstats.Stats(profiler)
+        profiling_state["snapshot"] = tracemalloc.take_snapshot()
+        profiling_state["elapsed"] = time.perf_counter() - profiling_state["started"]
+        if stop:
+            profiling_state["profiler"] = None
+            if profiling_state["owns_tracemalloc"]:
+                tracemalloc.stop()
+        else:
+            profiler.enable()
+    return profiling_state["stats"] is not None
+
+def render_profile_report(limit=PROFILE_TOP):
+    #可在背景執行緒執行；使用 collect_profile 取得的最後一份資料
+    buffer = io.StringIO()
+    buffer.write(f"# 執行期分析報告 (Profile report)\n分析時間: {profiling_state['elapsed']:.1f} 秒\n\n")
+    buffer.write(f"## 累計時間最多的函式 (Top {limit} functions by cumulative time)\n")
+    stats = profiling_state["stats"]
+    stats.stream = buffer
+    stats.sort_stats("cumulative").print_stats(limit)
+
+    snapshot = profiling_state["snapshot"].filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, cProfile.__file__),
+        tracemalloc.Filter(False, pstats.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<unknown>")
+    ))
+    buffer.write(f"\n## 記憶體配置最多的位置 (Top {limit} allocation sites)\n")
+    for stat in snapshot.statistics("lineno")[:limit]:
+        frame = stat.traceback[0]
+        buffer.write(f"{stat.size / 1024:10.1f} KiB {stat.count:8d} blocks  {frame.filename}:{frame.lineno}\n")
+    return buffer.getvalue()
+
+
+ITEM_API_URL = os.getenv("ITEM_API_URL", "https://api.playmonumenta.com/items")
+
+def item_meta_path(path):
+    #記錄 API 回傳的 ETag / Last-Modified，供下次條件式請求使用
+    return os.path.splitext(path)[0] + "_meta.json"
+
+def write_item_data(raw, path, validators):
+    #在背景執行緒解析並以暫存檔 + rename 的方式原子寫入
+    data = json.loads(raw)
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(temp_path, path)
+    with open(item_meta_path(path), "w", encoding="utf-8") as f:
+        json.dump(validators, f, ensure_ascii=False, indent=4)
+
+async def update_item_data(path="item_data.json", url=ITEM_API_URL):
+    #回傳 True: 已更新, None: 資料未變動, False: 失敗
+    validators = {}
+    if os.path.exists(path) and os.path.exists(item_meta_path(path)):
+        with open(item_meta_path(path), "r", encoding="utf-8") as f:
+            validators = json.load(f)
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
 
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
+            async with session.get(url, headers=headers) as response:
+                if response.status == 304:
+                    print("✅ item_data.json 已是最新版本")
+                    return None
+                response.raise_for_status()
+                raw = await response.read()
+                validators = {
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified")
+                }
+        await asyncio.to_thread(write_item_data, raw, path, validators)
         print("✅ 成功更新 item_data.json！")
         return True
 
-    except requests.RequestException as e:
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         print(f"❌ 無法連線 API：{e}")
         return False
-    
+    except ValueError as e:
+        print(f"❌ API 資料格式錯誤：{e}")
+        return False
+
+SNAPSHOT_VERSION = 2
+
+def snapshot_path(path):
+    return os.path.splitext(path)[0] + ".snapshot"
+
+def file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()[:12]
+
+def save_snapshot(path, item_data, search_index):
+    #快照以來源 JSON 的雜湊為鍵；卡片快取以 id(item) 為鍵，無法跨行程沿用，存成空的
+    header = {"version": SNAPSHOT_VERSION, "digest": file_digest(path)}
+    search_index = dict(search_index, render_cache={"texts": {}, "hits": 0, "misses": 0})
+    temp_path = snapshot_path(path) + ".tmp"
+    with open(temp_path, "wb") as f:
+        pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump((item_data, search_index), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, snapshot_path(path))
+
+def load_snapshot(path):
+    #快照不存在、版本或雜湊不符、lore 附檔遺失時回傳 None
+    if not os.path.exists(snapshot_path(path)):
+        return None
+    digest = file_digest(path)
+    try:
+        with open(snapshot_path(path), "rb") as f:
+            header = pickle.load(f)
+            if header != {"version": SNAPSHOT_VERSION, "digest": digest}:
+                return None
+            item_data, search_index = pickle.load(f)
+    except Exception as e:
+        print(f"⚠️ 無法讀取索引快照：{e}")
+        return None
+    sidecar_path = os.path.join(os.path.dirname(path), f"item_lore_{digest}.jsonl")
+    if not os.path.exists(sidecar_path):
+        return None
+    return item_data, search_index
+
+def prepare_item_data(path, previous=None):
+    #讀取並建立索引（可在背景執行緒執行），回傳 (item_data, search_index, 變動統計)
+    #previous 為目前的 (item_data, search_index)，提供時只修補有變動的物品
+    #沒有 previous 時優先讀取快照，跳過 JSON 解析與建立索引
+    if previous is None:
+        snapshot = load_snapshot(path)
+        if snapshot is not None:
+            item_data, search_index = snapshot
+            return item_data, search_index, {"added": len(item_data), "changed": 0, "removed": 0}
+        item_data = load_item_store(path)
+        search_index = build_index(item_data)
+        changes = {"added": len(item_data), "changed": 0, "removed": 0}
+    else:
+        old_data, old_index = previous
+        item_data = load_item_store(path, old_data)
+        search_index, changes = update_index(old_index, old_data, item_data)
+    save_snapshot(path, item_data, search_index)
+    return item_data, search_index, changes
+
+# ----------------- 精簡物品資料 -----------------
+ITEM_RECORD_FIELDS = ("name", "masterwork", "type", "base_item", "region", "tier", "location", "power", "class_name")
+STAT_LOCKED = 1
+STAT_IS_DICT = 2
+STAT_IS_FLOAT = 4
+
+class SidecarStore:
+    #lore 等不常用欄位存在 jsonl 附檔，只在需要時依位移讀取
+    __slots__ = ("path",)
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self, offset, length):
+        if not length:
+            return {}
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                return json.loads(f.read(length))
+        except OSError:
+            #舊索引換下後附檔可能已被清除
+            return {}
+
+class ItemRecord:
+    #以 __slots__ 儲存 !find 需要的欄位，stats 打包成陣列，介面與 dict.get 相容
+    #extra 為 (附檔, 位移, 長度)，digest 為原始內容雜湊，用於更新時比對
+    __slots__ = ITEM_RECORD_FIELDS + ("stat_keys", "stat_values", "stat_flags", "extra", "digest")
+
+    def __init__(self, item, extra, digest):
+        for field in ITEM_RECORD_FIELDS:
+            value = item.get(field)
+            setattr(self, field, sys.intern(value) if isinstance(value, str) else value)
+        stats = item.get("stats", {})
+        self.stat_keys = tuple(sys.intern(key) for key in stats)
+        self.stat_values = array("d")
+        self.stat_flags = array("b")
+        for stat_value in stats.values():
+            value, locked = unpack_stat(stat_value)
+            flags = (STAT_LOCKED if locked else 0) | (STAT_IS_DICT if isinstance(stat_value, dict) else 0)
+            if isinstance(value, float):
+                flags |= STAT_IS_FLOAT
+            self.stat_values.append(value)
+            self.stat_flags.append(flags)
+        self.extra = extra
+        self.digest = digest
+
+    def stats(self):
+        stats = {}
+        for key, value, flags in zip(self.stat_keys, self.stat_values, self.stat_flags):
+            value = value if flags & STAT_IS_FLOAT else int(value)
+            if flags & STAT_IS_DICT:
+                stats[key] = {"locked": bool(flags & STAT_LOCKED), "value": value}
+            else:
+                stats[key] = value
+        return stats
+
+    def get(self, key, default=None):
+        if key == "stats":
+            return self.stats()
+        if key in ITEM_RECORD_FIELDS:
+            value = getattr(self, key)
+            return default if value is None else value
+        sidecar, offset, length = self.extra
+        return sidecar.read(offset, length).get(key, default)
+
+def item_digest(item):
+    return hashlib.sha1(json.dumps(item, ensure_ascii=False, sort_keys=True).encode("utf-8")).digest()
+
+def build_item_store(data, sidecar_path, previous=None):
+    #轉成 ItemRecord，lore/mmlore 等欄位寫入附檔（同內容的附檔直接沿用）
+    #轉換完的原始 dict 會從 data 中移除，讓記憶體峰值維持在解析 JSON 的大小
+    #內容雜湊與 previous 相同的物品沿用舊的 ItemRecord，只更新附檔位置
+    sidecar = SidecarStore(sidecar_path)
+    temp_path = sidecar_path + ".tmp"
+    write_sidecar = not os.path.exists(sidecar_path)
+    items = {}
+    offset = 0
+    with open(temp_path if write_sidecar else os.devnull, "wb") as f:
+        for item_key in list(data):
+            item = data.pop(item_key)
+            extra = {key: value for key, value in item.items() if key not in ITEM_RECORD_FIELDS and key != "stats"}
+            line = (json.dumps(extra, ensure_ascii=False) + "\n").encode("utf-8") if extra else b""
+            digest = item_digest(item)
+            record = previous.get(item_key) if previous else None
+            if record is not None and record.digest == digest:
+                record.extra = (sidecar, offset, len(line))
+            else:
+                record = ItemRecord(item, (sidecar, offset, len(line)), digest)
+            items[sys.intern(item_key)] = record
+            f.write(line)
+            offset += len(line)
+    if write_sidecar:
+        os.replace(temp_path, sidecar_path)
+    return items
+
+def load_item_store(path, previous=None):
+    with open(path, "rb") as f:
+        raw = f.read()
+    digest = hashlib.sha1(raw).hexdigest()[:12]
+    data = json.loads(raw)
+    del raw
+
+    folder = os.path.dirname(path)
+    sidecar_path = os.path.join(folder, f"item_lore_{digest}.jsonl")
+    items = build_item_store(data, sidecar_path, previous)
+
+    #清除舊版本的附檔
+    for old_path in glob.glob(os.path.join(folder, "item_lore_*.jsonl")):
+        if old_path != sidecar_path:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+    return items
+
+NGRAM_SIZE = 3
+
+def name_grams(name):
+    #取出名稱中所有長度 1~3 的子字串，短查詢可直接對應單一倒排表
+    grams = set()
+    for size in range(1, NGRAM_SIZE + 1):
+        for i in range(len(name) - size + 1):
+            grams.add(name[i:i + size])
+    return grams
+
+def index_name(item_key, item):
+    #只索引非大師級或 4 星以上的物品，回傳小寫名稱，不索引時回傳 None
+    masterwork = int(item.get("masterwork", -1))
+    if masterwork == -1 or masterwork >= 4:
+        return item.get("name", item_key).lower()
+    return None
+
 def build_index(data):
-    #將資料名稱轉成小寫後儲存
-    index = []
+    #將資料名稱轉成小寫後儲存，並建立 n-gram 倒排索引
+    entries = []
+    keys = {}
+    grams = {}
     for item_key, item in data.items():
-        masterwork = int(item.get("masterwork", -1))
-        if masterwork == -1 or masterwork >= 4:
-            name = item.get("name", item_key).lower()
-            index.append((item, name))
-    return index
-
-def search_items(query, index):
-    #查詢時直接比對是否為子字串
-    query_string = query.lower().strip()
+        name = index_name(item_key, item)
+        if name is not None:
+            entry_id = len(entries)
+            entries.append((item, name))
+            keys[item_key] = entry_id
+            for gram in name_grams(name):
+                grams.setdefault(gram, []).append(entry_id)
+    #倒排表存成排序好的 int32 陣列，比 set 省下大量記憶體
+    grams = {gram: np.array(posting, dtype=np.int32) for gram, posting in grams.items()}
+    return {
+        "generation": 0,
+        "entries": entries,
+        "keys": keys,
+        "grams": grams,
+        "columns": build_stat_columns(entries),
+        "completions": build_completions(entries),
+        "render_cache": {"texts": {}, "hits": 0, "misses": 0}
+    }
+
+def update_index(index, old_data, new_data):
+    #比對新舊資料（沿用的 ItemRecord 即代表內容未變），只修補變動物品的倒排表、欄位與卡片快取
+    #不修改舊索引，回傳新的索引讓呼叫端一次替換；移除的物品留下空位 (None)
+    entries = list(index["entries"])
+    keys = dict(index["keys"])
+    texts = dict(index["render_cache"]["texts"])
+    changes = {"added": 0, "changed": 0, "removed": 0}
+
+    #(entry_id, item, name)，item 為 None 表示移除
+    patches = []
+    for item_key, item in old_data.items():
+        if item_key not in new_data:
+            changes["removed"] += 1
+            if item_key in keys:
+                patches.append((keys.pop(item_key), None, None))
+    for item_key, item in new_data.items():
+        old_item = old_data.get(item_key)
+        if old_item is item:
+            continue
+        changes["changed" if old_item is not None else "added"] += 1
+        name = index_name(item_key, item)
+        if item_key in keys:
+            entry_id = keys[item_key] if name is not None else keys.pop(item_key)
+        elif name is not None:
+            entry_id = len(entries)
+            entries.append(None)
+            keys[item_key] = entry_id
+        else:
+            continue
+        patches.append((entry_id, item if name is not None else None, name))
+
+    if not patches:
+        return index, changes
+
+    size = len(entries)
+    patched_ids = np.array(sorted(entry_id for entry_id, item, name in patches), dtype=np.int32)
+    gram_removed = {}
+    gram_added = {}
+    old_stat_keys = set()
+    new_stats = {}
+    for entry_id, item, name in patches:
+        if entry_id < len(index["entries"]) and index["entries"][entry_id] is not None:
+            old_item, old_name = index["entries"][entry_id]
+            texts.pop(id(old_item), None)
+            old_stat_keys.update(old_item.get("stats", {}))
+            for gram in name_grams(old_name):
+                gram_removed.setdefault(gram, []).append(entry_id)
+        entries[entry_id] = (item, name) if item is not None else None
+        if item is None:
+            continue
+        for gram in name_grams(name):
+            gram_added.setdefault(gram, []).append(entry_id)
+        for key, stat_value in item.get("stats", {}).items():
+            value, locked = unpack_stat(stat_value)
+            if isinstance(value, (int, float)):
+                new_stats.setdefault(key, ([], []))
+                new_stats[key][0].append(entry_id)
+                new_stats[key][1].append(value)
+
+    #倒排表：先移除舊名稱的 gram，再併入新名稱的 gram（union1d 會保持排序）
+    grams = dict(index["grams"])
+    for gram, ids in gram_removed.items():
+        posting = np.setdiff1d(grams[gram], ids, assume_unique=True)
+        if len(posting):
+            grams[gram] = posting.astype(np.int32)
+        else:
+            del grams[gram]
+    for gram, ids in gram_added.items():
+        grams[gram] = np.union1d(grams.get(gram, np.empty(0, dtype=np.int32)), ids).astype(np.int32)
+
+    #欄位：延長陣列後覆寫變動位置，stat 稀疏欄位移除舊值再附加新值
+    old_columns = index["columns"]
+    grow = size - old_columns["size"]
+    live = np.concatenate([old_columns["live"], np.ones(grow, dtype=bool)])
+    categories = {}
+    for field, (labels, codes) in old_columns["categories"].items():
+        labels = list(labels)
+        lookup = {label: code for code, label in enumerate(labels)}
+        codes = np.concatenate([codes, np.zeros(grow, dtype=np.int32)])
+        for entry_id, item, name in patches:
+            if item is not None:
+                label = item.get(field) or ""
+                if label not in lookup:
+                    lookup[label] = len(labels)
+                    labels.append(label)
+                codes[entry_id] = lookup[label]
+        categories[field] = (labels, codes)
+    for entry_id, item, name in patches:
+        live[entry_id] = item is not None
+
+    stats = dict(old_columns["stats"])
+    for key in old_stat_keys | set(new_stats):
+        ids, values = stats.get(key, (np.empty(0, dtype=np.int32), np.empty(0)))
+        keep = ~np.isin(ids, patched_ids)
+        added_ids, added_values = new_stats.get(key, ([], []))
+        ids = np.concatenate([ids[keep], np.array(added_ids, dtype=np.int32)])
+        values = np.concatenate([values[keep], np.array(added_values, dtype=np.float64)])
+        if len(ids):
+            stats[key] = (ids, values)
+        else:
+            stats.pop(key, None)
+
+    render_cache = index["render_cache"]
+    return {
+        "generation": index["generation"] + 1,
+        "entries": entries,
+        "keys": keys,
+        "grams": grams,
+        "columns": {"size": size, "live": live, "categories": categories, "stats": stats},
+        "completions": build_completions(entries),
+        "render_cache": {"texts": texts, "hits": render_cache["hits"], "misses": render_cache["misses"]}
+    }, changes
+
+def build_completions(entries):
+    #自動完成用的排序名稱陣列，以 bisect 找出前綴範圍，範圍開頭即為前 N 筆候選
+    names = {}
+    for entry in entries:
+        if entry is not None:
+            item, name = entry
+            names.setdefault(name, item.get("name", name))
+    keys = sorted(names)
+    return {"keys": keys, "names": [names[key] for key in keys]}
+
+def complete_item_names(prefix, index, limit=25):
+    completions = index["completions"]
+    keys = completions["keys"]
+    prefix = prefix.lower().lstrip()
     results = []
-    for item, name in index:
-        if query_string in name:
-            results.append(item)
+    position = bisect.bisect_left(keys, prefix)
+    while position < len(keys) and len(results) < limit and keys[position].startswith(prefix):
+        results.append(completions["names"][position])
+        position += 1
     return results
 
+def query_grams(query_string):
+    #查詢字串長度 <= 3 時本身就是一個 gram，否則取所有三字元片段
+    if len(query_string) <= NGRAM_SIZE:
+        return {query_string}
+    return {query_string[i:i + NGRAM_SIZE] for i in range(len(query_string) - NGRAM_SIZE + 1)}
+
+def search_entry_ids(query_string, index):
+    #以倒排表交集取得候選，再確認是否為子字串（結果與逐筆比對完全相同）
+    entries = index["entries"]
+    if not query_string:
+        return [entry_id for entry_id, entry in enumerate(entries) if entry is not None]
+
+    postings = []
+    for gram in query_grams(query_string):
+        posting = index["grams"].get(gram)
+        if posting is None:
+            return []
+        postings.append(posting)
+    postings.sort(key=len)
+    candidates = postings[0]
+    for posting in postings[1:]:
+        candidates = np.intersect1d(candidates, posting, assume_unique=True)
+        if not len(candidates):
+            return []
+
+    if len(query_string) <= NGRAM_SIZE:
+        return candidates.tolist()
+    return [entry_id for entry_id in candidates.tolist() if query_string in entries[entry_id][1]]
+
+def substring_distance(query_string, name, max_distance):
+    #查詢字串與名稱任一子字串的最小編輯距離，超過上限即提早結束
+    previous = [0] * (len(name) + 1)
+    for i, query_char in enumerate(query_string, 1):
+        current = [i]
+        for j, name_char in enumerate(name, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (query_char != name_char)
+            ))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return min(previous)
+
+def fuzzy_search_entry_ids(query, index, limit=5, max_distance=None):
+    #容錯搜尋：以 trigram 重疊數篩選候選，再依編輯距離與字首/字詞邊界排序
+    query_string = " ".join(query.lower().split())
+    if not query_string:
+        return []
+    if max_distance is None:
+        max_distance = min(2, len(query_string) // 5)
+
+    #每一次編輯最多破壞 NGRAM_SIZE 個 gram，共享數不足者不可能在距離上限內
+    grams = query_grams(query_string)
+    required = max(1, len(grams) - NGRAM_SIZE * max_distance)
+    postings = [index["grams"][gram] for gram in grams if gram in index["grams"]]
+    if not postings:
+        return []
+    entry_ids, shared = np.unique(np.concatenate(postings), return_counts=True)
+
+    first_word = query_string.split()[0][:NGRAM_SIZE]
+    scored = []
+    for entry_id in entry_ids[shared >= required].tolist():
+        item, name = index["entries"][entry_id]
+        distance = 0 if query_string in name else substring_distance(query_string, name, max_distance)
+        if distance > max_distance:
+            continue
+        prefix = name.startswith(first_word)
+        boundary = prefix or any(word.startswith(first_word) for word in name.split())
+        scored.append((distance, not prefix, not boundary, len(name) - len(query_string), entry_id))
+
+    scored.sort()
+    return [entry[-1] for entry in scored[:limit]]
+
+CATEGORY_FIELDS = ("region", "tier", "type", "location")
+STAT_OPERATORS = {
+    ">=": operator.ge, "<=": operator.le, "!=": operator.ne,
+    ">": operator.gt, "<": operator.lt, "=": operator.eq
+}
+CATEGORY_FILTER_PATTERN = re.compile(r'^(region|tier|type|location|sort):(\S+)$', re.IGNORECASE)
+STAT_FILTER_PATTERN = re.compile(r'^([a-z_]+)(>=|<=|!=|>|<|=)(-?\d+(?:\.\d+)?)$', re.IGNORECASE)
+
+def unpack_stat(stat_value):
+    #stat 可能是數值或 {"value", "locked"} 結構
+    if isinstance(stat_value, dict):
+        return stat_value.get("value"), stat_value.get("locked", False)
+    return stat_value, False
+
+def build_stat_columns(entries):
+    #類別欄位存成整數代碼陣列，每個 stat 存成稀疏欄位 (索引陣列, 數值陣列)
+    categories = {}
+    for field in CATEGORY_FIELDS:
+        labels = {}
+        codes = np.empty(len(entries), dtype=np.int32)
+        for entry_id, (item, name) in enumerate(entries):
+            codes[entry_id] = labels.setdefault(item.get(field) or "", len(labels))
+        categories[field] = (list(labels), codes)
+
+    stat_ids = {}
+    stat_values = {}
+    for entry_id, (item, name) in enumerate(entries):
+        for key, stat_value in item.get("stats", {}).items():
+            value, locked = unpack_stat(stat_value)
+            if isinstance(value, (int, float)):
+                stat_ids.setdefault(key, []).append(entry_id)
+                stat_values.setdefault(key, []).append(value)
+    stats = {
+        key: (np.array(ids, dtype=np.int32), np.array(stat_values[key], dtype=np.float64))
+        for key, ids in stat_ids.items()
+    }
+    return {"size": len(entries), "live": np.ones(len(entries), dtype=bool), "categories": categories, "stats": stats}
+
+def stat_column(columns, key):
+    #展開成完整欄位，沒有該 stat 的物品為 NaN
+    column = np.full(columns["size"], np.nan)
+    if key in columns["stats"]:
+        ids, values = columns["stats"][key]
+        column[ids] = values
+    return column
+
+def parse_stat_query(query):
+    #解析 type:charm region:isles armor>=10 sort:-speed_percent，沒有任何條件時回傳 None
+    stat_query = {"text": [], "categories": [], "stats": [], "sort": []}
+    for token in query.split():
+        category_match = CATEGORY_FILTER_PATTERN.match(token)
+        stat_match = STAT_FILTER_PATTERN.match(token)
+        if category_match:
+            field = category_match.group(1).lower()
+            value = category_match.group(2).lower()
+            if field == "sort":
+                stat_query["sort"].append((value.lstrip("+-"), value.startswith("-")))
+            else:
+                stat_query["categories"].append((field, value.replace("_", " ")))
+        elif stat_match:
+            stat_query["stats"].append((stat_match.group(1).lower(), stat_match.group(2), float(stat_match.group(3))))
+        else:
+            stat_query["text"].append(token)
+    if not (stat_query["categories"] or stat_query["stats"] or stat_query["sort"]):
+        return None
+    stat_query["text"] = " ".join(stat_query["text"]).lower()
+    return stat_query
+
+def query_entry_ids(stat_query, index):
+    #以向量化遮罩過濾類別與數值條件，再依 sort 欄位排序
+    columns = index["columns"]
+    mask = columns["live"].copy()
+
+    if stat_query["text"]:
+        text_mask = np.zeros(columns["size"], dtype=bool)
+        text_mask[search_entry_ids(stat_query["text"], index)] = True
+        mask &= text_mask
+
+    for field, value in stat_query["categories"]:
+        labels, codes = columns["categories"][field]
+        matched = [code for code, label in enumerate(labels) if value in label.lower()]
+        mask &= np.isin(codes, matched)
+
+    for key, op, number in stat_query["stats"]:
+        column = stat_column(columns, key)
+        mask &= ~np.isnan(column) & STAT_OPERATORS[op](column, number)
+
+    entry_ids = np.flatnonzero(mask)
+    if stat_query["sort"]:
+        #np.lexsort 以最後一個鍵為主鍵且為穩定排序，NaN 會排在最後
+        sort_keys = []
+        for key, descending in reversed(stat_query["sort"]):
+            column = stat_column(columns, key)[entry_ids]
+            sort_keys.append(-column if descending else column)
+        entry_ids = entry_ids[np.lexsort(sort_keys)]
+    return entry_ids.tolist()
+
+QUERY_CACHE_SIZE = 256
+query_cache = {"generation": None, "results": OrderedDict(), "hits": 0, "misses": 0}
+
+def normalize_query(query):
+    #大小寫統一並合併連續空白，作為查詢快取的鍵
+    return " ".join(query.lower().split())
+
+@timed("find_items")
+def find_items(query, index, limit=5):
+    #!find 的完整查詢流程（條件查詢 / 完全符合依相關度排序 / 容錯搜尋），結果以 LRU 快取
+    #回傳 (前 limit 筆物品, 符合總數, 模式)，模式為 "query"、"exact" 或 "fuzzy"
+    if query_cache["generation"] != index["generation"]:
+        query_cache["generation"] = index["generation"]
+        query_cache["results"].clear()
+
+    query_string = normalize_query(query)
+    cache_key = (query_string, limit)
+    cached = query_cache["results"].get(cache_key)
+    if cached is not None:
+        query_cache["hits"] += 1
+        query_cache["results"].move_to_end(cache_key)
+        entry_ids, total, mode = cached
+    else:
+        query_cache["misses"] += 1
+        stat_query = parse_stat_query(query_string)
+        if stat_query:
+            entry_ids = query_entry_ids(stat_query, index)
+            total = len(entry_ids)
+            entry_ids = entry_ids[:limit]
+            mode = "query"
+        else:
+            total = len(search_entry_ids(query_string, index))
+            if total:
+                entry_ids = fuzzy_search_entry_ids(query_string, index, limit, max_distance=0)
+                mode = "exact"
+            else:
+                entry_ids = fuzzy_search_entry_ids(query_string, index, limit)
+                mode = "fuzzy"
+        query_cache["results"][cache_key] = (entry_ids, total, mode)
+        if len(query_cache["results"]) > QUERY_CACHE_SIZE:
+            query_cache["results"].popitem(last=False)
+
+    entries = index["entries"]
+    return [entries[entry_id][0] for entry_id in entry_ids], total, mode
+
+def query_cache_stats():
+    total = query_cache["hits"] + query_cache["misses"]
+    hit_rate = query_cache["hits"] / total * 100 if total else 0
+    return (
+        f"🔎 查詢結果快取: {len(query_cache['results'])}/{QUERY_CACHE_SIZE} 筆 (索引版本 {query_cache['generation']})\n"
+        f"└ 命中(Hits): {query_cache['hits']} 未命中(Misses): {query_cache['misses']} 命中率: {hit_rate:.1f}%"
+    )
+
 def format_stat_key(key: str) -> str:
     # 移除 _percent 或 _flat
     for suffix in ["_percent", "_flat"]:
@@ -98,12 +848,7 @@ def format_item_short(item):
     stats = item.get("stats", {})
     for key, stat_value in stats.items():
         # 是否為 dict 結構（有 locked / value）
-        if isinstance(stat_value, dict):
-            value = stat_value.get("value")
-            locked = stat_value.get("locked", False)
-        else:
-            value = stat_value
-            locked = False
+        value, locked = unpack_stat(stat_value)
 
         is_percent = key.endswith("_percent")
         stat_name = format_stat_key(key)
@@ -120,8 +865,6 @@ def format_item_short(item):
 
     return "\n".join(lines)
 
-
-
     # 嘗試頁碼
     match = page_pattern.search(log_line)
     if match:
@@ -131,112 +874,174 @@ def format_item_short(item):
 
     return False
 
-def regular_expression(log_line):
-    # 含色碼版本
-    color_action_pattern = re.compile(
-        r'^\[\d{2}:\d{2}:\d{2}\] \[Render thread/INFO\]: \[System\] \[CHAT\] '
-        r'(\d+\.\d+)/(h|d|m) ago §[0-9a-fk-or][+-] (\w+)§f (added|removed) x(\d+) (\w+)§f\.$'
-    )
-
-    # 無色碼版本
-    plain_action_pattern = re.compile(
-        r'^\[\d{2}:\d{2}:\d{2}\] \[Render thread/INFO\]: \[System\] \[CHAT\] '
-        r'(\d+\.\d+)/(h|d|m) ago\s+[ac][+-]\s+(\w+)\s+f\s+(added|removed) x(\d+) (\w+)\s+f\.$'
+def format_item_cached(item, index):
+    #卡片文字跟著索引一起快取，更新資料換上新索引時快取也一併換掉
+    #索引持有所有物品，id(item) 在快取存活期間不會被重複使用
+    cache = index["render_cache"]
+    text = cache["texts"].get(id(item))
+    if text is None:
+        cache["misses"] += 1
+        text = format_item_short(item)
+        cache["texts"][id(item)] = text
+    else:
+        cache["hits"] += 1
+    return text
+
+def render_cache_stats(index):
+    cache = index["render_cache"]
+    total = cache["hits"] + cache["misses"]
+    hit_rate = cache["hits"] / total * 100 if total else 0
+    return (
+        f"🗂️ 物品卡片快取: {len(cache['texts'])}/{len(index['entries'])} 筆\n"
+        f"└ 命中(Hits): {cache['hits']} 未命中(Misses): {cache['misses']} 命中率: {hit_rate:.1f}%"
     )
 
-    # 頁碼（不受色碼影響）
-    page_pattern = re.compile(r'f(\d+)/(\d+)')
+# ----------------- 交易紀錄詞法分析 -----------------
+CHAT_PREFIX = "[Render thread/INFO]: [System] [CHAT] "
+CHAT_PREFIX_OFFSET = len("[00:00:00] ")
+
+# 含色碼 / 無色碼兩種交易格式合併成一個交替式；另取出紀錄時間與 "x.x/h ago" 供帳本推算交易時間
+ACTION_PATTERN = re.compile(
+    r'^\[(\d{2}:\d{2}:\d{2})\] \[Render thread/INFO\]: \[System\] \[CHAT\] '
+    r'(\d+\.\d+/[hdm]) ago'
+    r'(?: §[0-9a-fk-or][+-] (\w+)§f (added|removed) x(\d+) (\w+)§f'
+    r'|\s+[ac][+-]\s+(\w+)\s+f\s+(added|removed) x(\d+) (\w+)\s+f)\.$'
+)
+# 無色碼版本（用於去除色碼後的比對）
+PLAIN_ACTION_PATTERN = re.compile(
+    r'^\[(\d{2}:\d{2}:\d{2})\] \[Render thread/INFO\]: \[System\] \[CHAT\] '
+    r'(\d+\.\d+/[hdm]) ago\s+[ac][+-]\s+(\w+)\s+f\s+(added|removed) x(\d+) (\w+)\s+f\.$'
+)
+COLOR_CODE_PATTERN = re.compile(r'§.')
+# 頁碼（不受色碼影響）
+PAGE_PATTERN = re.compile(r'f(\d+)/(\d+)')
+# 自動 (/Project_Epic-plots) 與手動座標合併成一個交替式，另保留自動版本處理同一行兩種座標的情況
+COORD_PATTERN = re.compile(r'\(x(-?\d+)/y(-?\d+)/z(-?\d+)(?:(/Project_Epic-plots)\)|\)(?!/))')
+COORD_AUTO_PATTERN = re.compile(r'\(x(-?\d+)/y(-?\d+)/z(-?\d+)/Project_Epic-plots\)')
 
-    # 嘗試含色碼版本
-    match = color_action_pattern.match(log_line)
-    if match:
-        _, _, username, action, count, item = match.groups()
-        return {
-            "user": username,
-            "action": 1 if action == "added" else -1,
-            "item": item,
-            "count": int(count)
-        }
-
-    # 若不成功，轉成無色碼再匹配
-    cleaned_line = re.sub(r'§.', '', log_line)
-    match = plain_action_pattern.match(cleaned_line)
-    if match:
-        _, _, username, action, count, item = match.groups()
-        return {
-            "user": username,
-            "action": 1 if action == "added" else -1,
-            "item": item,
-            "count": int(count)
-        }
+def regular_expression(log_line):
+    #回傳交易動作 dict、頁碼 (目前頁, 總頁數) 或 False
+    #沒有 CHAT 前綴也沒有色碼的行不可能是交易動作，直接略過
+    has_color = "§" in log_line
+    if has_color or log_line.startswith(CHAT_PREFIX, CHAT_PREFIX_OFFSET):
+        match = ACTION_PATTERN.match(log_line)
+        if match:
+            logged, ago, username, action, count, item, plain_username, plain_action, plain_count, plain_item = match.groups()
+            if username is not None:
+                return {"user": username, "action": 1 if action == "added" else -1, "item": item, "count": int(count), "logged": logged, "ago": ago}
+            #無色碼分支只在整行沒有色碼時成立（與去除色碼後再比對相同）
+            if not has_color:
+                return {"user": plain_username, "action": 1 if plain_action == "added" else -1, "item": plain_item, "count": int(plain_count), "logged": logged, "ago": ago}
+        if has_color:
+            # 若不成功，轉成無色碼再匹配
+            match = PLAIN_ACTION_PATTERN.match(COLOR_CODE_PATTERN.sub('', log_line))
+            if match:
+                logged, ago, username, action, count, item = match.groups()
+                return {"user": username, "action": 1 if action == "added" else -1, "item": item, "count": int(count), "logged": logged, "ago": ago}
 
     # 頁碼檢查
-    match = page_pattern.search(log_line)
+    match = PAGE_PATTERN.search(log_line)
     if match:
         return (int(match.group(1)), int(match.group(2)))
 
     return False
 
-def check_changed_item(filtered, playerLog, ignore, nbt):
+def lex_coordinates(line):
+    #回傳 (座標種類, 座標)，座標種類為 "auto"（/Project_Epic-plots，優先）、"manual" 或 None
+    match = COORD_PATTERN.search(line)
+    if not match:
+        return None, None
+    if match.group(4):
+        return "auto", tuple(map(int, match.group(1, 2, 3)))
+    #同一行先出現手動座標時，仍以後面的自動座標為準
+    auto_match = COORD_AUTO_PATTERN.search(line, match.end())
+    if auto_match:
+        return "auto", tuple(map(int, auto_match.groups()))
+    return "manual", tuple(map(int, match.group(1, 2, 3)))
+
+TRADE_IGNORE_LIST = {"XmasTiramisu"}
+MISTRADE_PRECISION = 10
+
+def build_trade_ledger(filtered, ignore, nbt):
+    #把各頁交易動作收進欄位式帳本：玩家與物品轉成整數 id，數量為帶正負號的 int64，再一次向量化加總
     if ignore:
-        IGNORELIST = {"XmasTiramisu"}
+        pages = [[action for action in pageData if action["user"] not in TRADE_IGNORE_LIST] for pageData in filtered.values()]
     else:
-        IGNORELIST = {}
-
-    amountChange = {
-        "experience_bottle": 0,
-        "dragon_breath": 0,
-        "sunflower": 0,
-        "prismarine_crystals": 0,
-        "prismarine_shard": 0,
-        "nether_star": 0,
-        "gray_dye": 0,
-        "firework_star": 0
-    }
-
-    CURRENCYMAP = {
-        "experience_bottle": "<:xp:1397875984484798475> XP",
-        "dragon_breath": "<:cxp:1397875964796469389> CXP",
-        "sunflower": "<:hxp:1397875942000558223> HXP",
-        "prismarine_shard": "<:cs:1397875907338960986> CS",
-        "prismarine_crystals": "<:ccs:1397875885146640404> CCS",
-        "nether_star": "<:hcs:1397875853693554688> HCS",
-        "gray_dye": "<:ar:1397875715105624145> AR",
-        "firework_star": "<:har:1397875820386848852> HAR"
-    }
-
-    result = ""
-    updatedLog = {}
-
-    for action in filtered:
-        user = action["user"]
-        item = action["item"]
-        count = int(action["count"]) * action["action"]
-
-        if user in IGNORELIST:
-            continue
-
-        if item in amountChange:
-            amountChange[item] += count
-
-        if user not in playerLog:
-            playerLog[user] = {}
-
-        if item not in playerLog[user]:
-            playerLog[user][item] = 0
-        playerLog[user][item] += count
-
+        pages = list(filtered.values())
+    actions = [action for pageData in pages for action in pageData]
+
+    #依第一次出現的順序配發 id，欄位以 itemgetter 一次取出
+    user_names = list(map(operator.itemgetter("user"), actions))
+    item_names = list(map(operator.itemgetter("item"), actions))
+    users = list(dict.fromkeys(user_names))
+    items = list(dict.fromkeys(item_names))
+    user_ids = dict(zip(users, range(len(users))))
+    item_ids = dict(zip(items, range(len(items))))
+    user_column = np.fromiter(map(user_ids.__getitem__, user_names), dtype=np.int64, count=len(actions))
+    item_column = np.fromiter(map(item_ids.__getitem__, item_names), dtype=np.int64, count=len(actions))
+    count_column = np.fromiter(map(operator.itemgetter("count"), actions), dtype=np.int64, count=len(actions))
+    count_column *= np.fromiter(map(operator.itemgetter("action"), actions), dtype=np.int64, count=len(actions))
     if nbt != "":
-        for user, items in playerLog.items():
-            if nbt in items:
-                updatedLog[user] = items
-        playerLog = updatedLog
-
-    for currency, amount in amountChange.items():
-        if amount != 0:
-            result += " └ " + CURRENCYMAP[currency] + " " + str(amount) + "\n"
+        #逐頁篩選的結果：玩家從第一次交易 nbt 物品的那一頁起才被保留，之前各頁都會被清掉
+        page_column = np.repeat(np.arange(len(pages), dtype=np.int64), [len(pageData) for pageData in pages])
+        start_page = np.full(len(users), len(filtered), dtype=np.int64)
+        nbt_id = item_ids.get(nbt)
+        if nbt_id is not None:
+            hit = item_column == nbt_id
+            np.minimum.at(start_page, user_column[hit], page_column[hit])
+        keep = page_column >= start_page[user_column]
+        user_column, item_column, count_column = user_column[keep], item_column[keep], count_column[keep]
+
+    #以 (玩家, 物品) 為鍵分組加總，順序依玩家與物品第一次出現的位置，與逐筆建立字典時相同
+    keys = user_column * max(len(items), 1) + item_column
+    pair_keys, first_seen, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    totals = np.zeros(len(pair_keys), dtype=np.int64)
+    np.add.at(totals, inverse, count_column)
+    pair_users = pair_keys // max(len(items), 1)
+    user_first_seen = np.full(len(users), len(keys), dtype=np.int64)
+    np.minimum.at(user_first_seen, user_column, np.arange(len(keys)))
+    order = np.lexsort((first_seen, user_first_seen[pair_users]))
+    return {
+        "users": users,
+        "items": items,
+        "pair_users": pair_users[order],
+        "pair_items": (pair_keys % max(len(items), 1))[order],
+        "totals": totals[order]
+    }
 
-    return (result, playerLog) if result else ("貨幣數量無變動\n", playerLog)
+def ledger_player_log(ledger):
+    #轉回 playerLog[玩家][物品] = 數量，只建立加總後的結果
+    playerLog = {}
+    users, items = ledger["users"], ledger["items"]
+    for user_id, item_id, total in zip(ledger["pair_users"].tolist(), ledger["pair_items"].tolist(), ledger["totals"].tolist()):
+        playerLog.setdefault(users[user_id], {})[items[item_id]] = total
+    return playerLog
+
+def round_precision(numerator, denominator, digits=MISTRADE_PRECISION):
+    #以整數分數 numerator/denominator 重現 Decimal(prec=10) 的有效位數捨入（四捨六入五成雙），回傳 (分子, 分母)
+    magnitude = abs(numerator)
+    if denominator == 1 and magnitude < 10 ** digits:
+        return numerator, denominator
+    #估計的指數最多小一位，只需往上修正一次
+    exponent = len(str(magnitude)) - len(str(denominator)) - digits
+    if exponent >= 0:
+        scaled, scale = magnitude, denominator * 10 ** exponent
+    else:
+        scaled, scale = magnitude * 10 ** -exponent, denominator
+    if scaled >= scale * 10 ** digits:
+        exponent += 1
+        scale *= 10
+    quotient, remainder = divmod(scaled, scale)
+    if remainder == 0:
+        return numerator, denominator
+    if remainder * 2 > scale or (remainder * 2 == scale and quotient % 2):
+        quotient += 1
+    if numerator < 0:
+        quotient = -quotient
+    return (quotient * 10 ** exponent, 1) if exponent >= 0 else (quotient, 10 ** -exponent)
+
+def subtract_precision(left, right):
+    return round_precision(left[0] * right[1] - right[0] * left[1], left[1] * right[1])
 
 def check_parameter(parameter):
     pattern = r"(\d+(?:\.\d+)?)\s+(\d+(?:\.\d+)?)\s+(XP|CXP|HXP|CS|CCS|HCS|AR|HAR)(?:\s+(0|1))?(?:\s+(0|1))?(?:\s+(.+))?"
@@ -253,14 +1058,9 @@ def check_parameter(parameter):
     else:
         return {"buyPrice": None, "sellPrice": None, "unit": "", "ignore_owner": False, "ignore_correct_trade":False, "nbt":""}
 
-def mistrade_calculator(userData, target, buyPrice, sellPrice):
-    from decimal import Decimal, getcontext
-    getcontext().prec = 10
-
-    #開啟 PIG 會員名單
-    with open("pig_vip.json", "r", encoding="utf-8") as f:
-        vip_data = json.load(f)
-    pig_vip = vip_data["PIG"]
+def mistrade_calculator(ledger, target, buyPrice, sellPrice):
+    #PIG 會員名單（記憶體快照）
+    pig_vip = load_pig_vip()
 
     CURRENCYMAP = {
         "experience_bottle": "XP",
@@ -282,61 +1082,503 @@ def mistrade_calculator(userData, target, buyPrice, sellPrice):
     wrong_currency_usage = {}
     wrong_payment = {}
     changedProductCountForPlayer = {}
-    
 
     target = target.upper()
-    target_base_currency = target[-2:]
-    target_region = REGIONMAP.get(target_base_currency)
-    target_multiplier = Decimal(CURRENCYMULTIPLIER[target])
-
-    for userName, changedItems in userData.items():
-        changedProductCount = 0
-        total_base_value = Decimal(0)
-        wrong_items = []
-
-        for itemName, itemCount in changedItems.items():
-            if itemName not in CURRENCYMAP:
-                changedProductCount += itemCount
-                continue
-
-            currency_name = CURRENCYMAP[itemName]
-            base_currency = currency_name[-2:]
-            currency_region = REGIONMAP.get(base_currency)
-
-            if currency_region != target_region:
-                wrong_items.append(currency_name)
-                continue
-
-            multiplier = Decimal(CURRENCYMULTIPLIER[currency_name])
-            total_base_value += Decimal(itemCount) * multiplier
-
-
+    target_region = REGIONMAP.get(target[-2:])
+    target_multiplier = CURRENCYMULTIPLIER[target]
+
+    #每種物品查一次倍率：商品為 0，同地區貨幣為基本單位倍率，其他地區貨幣標記為錯誤貨幣
+    is_product = np.array([item not in CURRENCYMAP for item in ledger["items"]], dtype=bool)
+    multiplier = np.array([CURRENCYMULTIPLIER[CURRENCYMAP[item]] if item in CURRENCYMAP and REGIONMAP.get(CURRENCYMAP[item][-2:]) == target_region else 0 for item in ledger["items"]], dtype=np.int64)
+    pair_users, pair_items, totals = ledger["pair_users"], ledger["pair_items"], ledger["totals"]
+    product_counts = np.zeros(len(ledger["users"]), dtype=np.int64)
+    np.add.at(product_counts, pair_users, np.where(is_product[pair_items], totals, 0))
+    pair_values = totals * multiplier[pair_items]
+    base_values = np.zeros(len(ledger["users"]), dtype=np.int64)
+    np.add.at(base_values, pair_users, pair_values)
+    #金額超過有效位數時原本會逐項捨入，這些玩家改為依物品順序逐項累加
+    magnitudes = np.zeros(len(ledger["users"]), dtype=np.int64)
+    np.add.at(magnitudes, pair_users, np.abs(pair_values))
+    rounded_values = {}
+    large = (magnitudes >= 10 ** MISTRADE_PRECISION)[pair_users] & (pair_values != 0)
+    for user_id, value in zip(pair_users[large].tolist(), pair_values[large].tolist()):
+        total = rounded_values.get(user_id, (0, 1))
+        rounded_values[user_id] = round_precision(total[0] + round_precision(value, 1)[0] * total[1], total[1])
+
+    wrong_pairs = ~is_product[pair_items] & (multiplier[pair_items] == 0)
+    for user_id, item_id in zip(pair_users[wrong_pairs].tolist(), pair_items[wrong_pairs].tolist()):
+        wrong_currency_usage.setdefault(ledger["users"][user_id], []).append(CURRENCYMAP[ledger["items"][item_id]])
+
+    #價格是 float，as_integer_ratio 取得與 Decimal(float) 相同的精確值
+    buy_ratio = float(buyPrice).as_integer_ratio()
+    sell_ratio = float(sellPrice).as_integer_ratio()
+    product_counts, base_values = product_counts.tolist(), base_values.tolist()
+    for user_id in dict.fromkeys(pair_users.tolist()):
+        userName = ledger["users"][user_id]
+        changedProductCount = product_counts[user_id]
         changedProductCountForPlayer.update({userName:changedProductCount})
-        paid_value = total_base_value / target_multiplier
-        wrong_payment_value = Decimal(0)
+        base_value = rounded_values.get(user_id, (base_values[user_id], 1))
+        paid_value = round_precision(base_value[0], base_value[1] * target_multiplier)
         #玩家購買
         if changedProductCount < 0:
-            if userName not in pig_vip:
-                totalBuyPrice = abs(Decimal(changedProductCount)) * Decimal(buyPrice)
-            elif userName in pig_vip:
-                totalBuyPrice = abs(Decimal(changedProductCount)) * Decimal(sellPrice)
-            wrong_payment_value = paid_value - totalBuyPrice
+            price = sell_ratio if userName in pig_vip else buy_ratio
+            #abs(Decimal(數量)) 會先捨入到有效位數再乘上價格
+            wrong_payment_value = subtract_precision(paid_value, round_precision(round_precision(-changedProductCount, 1)[0] * price[0], price[1]))
         #玩家販售
         elif changedProductCount > 0:
-            totalSellPrice = Decimal(changedProductCount) * Decimal(-sellPrice)
-            wrong_payment_value = paid_value - totalSellPrice
+            wrong_payment_value = subtract_precision(paid_value, round_precision(-changedProductCount * sell_ratio[0], sell_ratio[1]))
         else:
             wrong_payment_value = paid_value
 
-        if wrong_payment_value != 0:
-            wrong_payment[userName] = float(wrong_payment_value)
+        if wrong_payment_value[0] != 0:
+            wrong_payment[userName] = wrong_payment_value[0] / wrong_payment_value[1]
 
-        if wrong_items:
-            wrong_currency_usage[userName] = wrong_items
-    
     return wrong_payment, wrong_currency_usage, changedProductCountForPlayer
 
-def handle_trade_log(message, file_lines, coord, auto_detect):
+# ----------------- 交易紀錄串流解析 -----------------
+
+def iter_decoded_lines(chunks):
+    #逐塊以增量 UTF-8 解碼並切行，切行規則與 str.splitlines() 相同
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    pending = ""
+    for chunk in chunks:
+        lines = (pending + decoder.decode(chunk)).splitlines(keepends=True)
+        pending = ""
+        #最後一段可能尚未結束（或是 \r\n 被切在兩塊之間），留到下一塊
+        if lines and (lines[-1].endswith("\r") or lines[-1].splitlines()[0] == lines[-1]):
+            pending = lines.pop()
+        for line in lines:
+            yield line.splitlines()[0]
+    yield from (pending + decoder.decode(b"", final=True)).splitlines()
+
+def segment_trade_log(lines, state):
+    #依座標切分交易紀錄，逐行產生 (座標, 詞法結果)；手動模式的座標首次出現時產生 (座標, None)
+    #自動模式 (/Project_Epic-plots) 收錄的是座標行的前一行，結束時每個座標補上 f1/1
+    #結束後 state["auto_detect"] 為最後的偵測模式
+    current_coords = None
+    auto_detect = False
+    seen = {}
+    previous = regular_expression("<無法取得前一行>")
+    for line in lines:
+        #每行只分類一次；座標行必含 "(x"，其他行不必進入座標比對
+        parsed = regular_expression(line)
+        if "(x" in line:
+            coord_kind, coords = lex_coordinates(line)
+            if coord_kind is not None:
+                current_coords = coords
+                auto_detect = coord_kind == "auto"
+
+        if auto_detect:
+            #前一行不是頁碼時才收錄
+            if not isinstance(previous, tuple):
+                seen[current_coords] = True
+                yield current_coords, previous
+        elif current_coords in seen:
+            yield current_coords, parsed
+        elif current_coords is not None:
+            seen[current_coords] = True
+            yield current_coords, None
+        previous = parsed
+
+    if auto_detect:
+        for coord in seen:
+            yield coord, (1, 1)
+    state["auto_detect"] = auto_detect
+
+def page_actions(totals):
+    #{(玩家, 物品): 數量} 轉回交易動作，依第一次出現的順序排列，build_trade_ledger 的結果與逐筆計算相同
+    return [{"user": user, "item": item, "count": total, "action": 1} for (user, item), total in totals.items()]
+
+def aggregate_trade_pages(parsed_lines):
+    #邊讀邊把交易動作加總成各頁的 (玩家, 物品) 數量：{座標: {頁碼: [交易動作]}}，重複的頁碼以後出現者為準
+    #不保留原始行與個別交易動作，記憶體只與頁數、玩家數與物品數有關，不隨紀錄行數增加
+    shops = {}
+    pending = {}
+    for coord, regexResult in parsed_lines:
+        if coord not in shops:
+            shops[coord] = {}
+            pending[coord] = {}
+        if isinstance(regexResult, dict):
+            key = (regexResult["user"], regexResult["item"])
+            pending[coord][key] = pending[coord].get(key, 0) + regexResult["count"] * regexResult["action"]
+        elif isinstance(regexResult, tuple) and regexResult[0] > 0:
+            shops[coord][regexResult[0]] = pending[coord]
+            pending[coord] = {}
+    return {coord: {page: page_actions(totals) for page, totals in pages.items()} for coord, pages in shops.items()}
+
+@timed("collect_trade_pages")
+def collect_trade_pages(lines):
+    #串接 詞法分析/切分 -> 彙整，回傳 (各座標頁面資料, 最後的偵測模式)
+    state = {}
+    shops = aggregate_trade_pages(segment_trade_log(lines, state))
+    return shops, state.get("auto_detect", False)
+
+# ----------------- 木桶(商店)資料 -----------------
+BARREL_DATA_PATH = "barrel_data.json"
+BARREL_GRID_SIZE = 4
+BARREL_TOLERANCE = 2
+barrel_cache = {"mtime": None, "barrels": {}, "grid": {}}
+
+def barrel_cell(coord):
+    return (coord[0] // BARREL_GRID_SIZE, coord[1] // BARREL_GRID_SIZE, coord[2] // BARREL_GRID_SIZE)
+
+def load_barrel_data(path=BARREL_DATA_PATH):
+    #只在檔案修改時間改變時重新讀取，並以網格建立空間索引
+    mtime = os.stat(path).st_mtime_ns
+    if barrel_cache["mtime"] != mtime:
+        with open(path, "r", encoding="utf-8") as f:
+            raw_data = json.load(f)
+        barrels = {}
+        grid = {}
+        for key_str, value in raw_data.items():
+            key_tuple = ast.literal_eval(key_str)
+            barrels[key_tuple] = value
+            grid.setdefault(barrel_cell(key_tuple), []).append(key_tuple)
+        barrel_cache.update(mtime=mtime, barrels=barrels, grid=grid)
+    return barrel_cache["barrels"]
+
+def barrels_near(coord, tolerance):
+    #回傳各軸誤差 tolerance 格內的登記座標
+    reach = -(-tolerance // BARREL_GRID_SIZE)
+    cell = barrel_cell(coord)
+    found = []
+    for dx in range(-reach, reach + 1):
+        for dy in range(-reach, reach + 1):
+            for dz in range(-reach, reach + 1):
+                for barrel in barrel_cache["grid"].get((cell[0] + dx, cell[1] + dy, cell[2] + dz), ()):
+                    if max(abs(a - b) for a, b in zip(barrel, coord)) <= tolerance:
+                        found.append(barrel)
+    return found
+
+def find_nearest_barrel(coord, tolerance=BARREL_TOLERANCE):
+    #座標差幾格時對應到登記座標，找不到或無法確定時回傳 None
+    #木桶常常相鄰擺放，差一格也可能是另一個未登記的木桶：只有範圍內恰好一個登記座標，
+    #而且誤差小於該木桶與最近的其他登記木桶間距的一半時才對應
+    load_barrel_data()
+    candidates = barrels_near(coord, tolerance)
+    if len(candidates) != 1:
+        return None
+    barrel = candidates[0]
+    offset = max(abs(a - b) for a, b in zip(barrel, coord))
+    spacing = min((max(abs(a - b) for a, b in zip(barrel, other)) for other in barrels_near(barrel, 2 * offset) if other != barrel), default=None)
+    if spacing is not None and 2 * offset >= spacing:
+        return None
+    return barrel
+
+# ----------------- 交易帳本資料庫 -----------------
+TRADE_LEDGER_PATH = "trade_ledger.db"
+TRADE_LEDGER_VERSION = 3
+#超過保留天數的交易動作在下次寫入時刪除，0 表示永久保留
+TRADE_LEDGER_RETENTION_DAYS = int(os.getenv("TRADE_LEDGER_RETENTION_DAYS", "30"))
+#"x.x/h ago" 只到小數一位，推算出的交易時間誤差為單位的 0.1
+TRADE_AGE_UNITS = {"m": 60, "h": 3600, "d": 86400}
+TRADE_MAX_TOLERANCE = max(TRADE_AGE_UNITS.values()) // 10
+#紀錄行只有時分秒，時間晚於上傳時間超過此值才視為前一天（容許玩家與主機的時鐘差）
+TRADE_CLOCK_SKEW = timedelta(hours=1)
+#解析紀錄時每累積這麼多筆交易動作就寫入資料庫一次
+TRADE_BATCH_SIZE = 5000
+#每筆交易動作記錄推算出的交易時間與誤差，以 (座標, 玩家, 物品, 數量) 加上時間去重
+#先前上傳過的交易也會寫入（duplicate_of 指向原本那一筆），供這次上傳的報告與一對一配對使用
+#page 為該座標在這次上傳中的頁面順序
+TRADE_LEDGER_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS trade_uploads (
+        id INTEGER PRIMARY KEY,
+        uploaded_at INTEGER NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS trade_actions (
+        id INTEGER PRIMARY KEY,
+        coord TEXT NOT NULL,
+        upload INTEGER NOT NULL,
+        page INTEGER,
+        traded_at INTEGER NOT NULL,
+        tolerance INTEGER NOT NULL,
+        user TEXT NOT NULL,
+        item TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        duplicate_of INTEGER
+    )""",
+    "CREATE INDEX IF NOT EXISTS trade_actions_time ON trade_actions (coord, traded_at)",
+    "CREATE INDEX IF NOT EXISTS trade_actions_upload ON trade_actions (upload, coord, page)",
+    "CREATE INDEX IF NOT EXISTS trade_actions_duplicate ON trade_actions (duplicate_of) WHERE duplicate_of IS NOT NULL",
+    #各座標 (玩家, 物品) 的累計數量，由觸發程序在寫入 / 刪除交易動作時增量維護
+    """CREATE TABLE IF NOT EXISTS trade_balances (
+        coord TEXT NOT NULL,
+        user TEXT NOT NULL,
+        item TEXT NOT NULL,
+        total INTEGER NOT NULL,
+        actions INTEGER NOT NULL,
+        PRIMARY KEY (coord, user, item)
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS trade_actions_insert AFTER INSERT ON trade_actions WHEN NEW.duplicate_of IS NULL BEGIN
+        INSERT INTO trade_balances (coord, user, item, total, actions) VALUES (NEW.coord, NEW.user, NEW.item, NEW.count, 1)
+            ON CONFLICT (coord, user, item) DO UPDATE SET total = total + excluded.total, actions = actions + 1;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trade_actions_delete AFTER DELETE ON trade_actions WHEN OLD.duplicate_of IS NULL BEGIN
+        UPDATE trade_balances SET total = total - OLD.count, actions = actions - 1 WHERE coord = OLD.coord AND user = OLD.user AND item = OLD.item;
+        DELETE FROM trade_balances WHERE coord = OLD.coord AND user = OLD.user AND item = OLD.item AND actions = 0;
+    END"""
+]
+
+def open_trade_ledger(path=TRADE_LEDGER_PATH):
+    #交易自行控制：寫入時以 BEGIN IMMEDIATE 讓同時進行的分析工作依序比對與寫入
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode = WAL")
+    if conn.execute("PRAGMA user_version").fetchone()[0] != TRADE_LEDGER_VERSION:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version == 2:
+                #第二版的資料都是不重複的交易，補上欄位後以現有資料建立累計數量
+                conn.execute("ALTER TABLE trade_actions ADD COLUMN duplicate_of INTEGER")
+                for statement in TRADE_LEDGER_SCHEMA:
+                    conn.execute(statement)
+                conn.execute(
+                    "INSERT INTO trade_balances (coord, user, item, total, actions) "
+                    "SELECT coord, user, item, SUM(count), COUNT(*) FROM trade_actions GROUP BY coord, user, item ORDER BY MIN(id)"
+                )
+            elif version != TRADE_LEDGER_VERSION:
+                #第一版以頁碼去重，沒有交易時間可以換算，舊資料直接捨棄
+                conn.execute("DROP TRIGGER IF EXISTS trade_actions_balance")
+                conn.execute("DROP TABLE IF EXISTS trade_balances")
+                conn.execute("DROP TABLE IF EXISTS trade_actions")
+                for statement in TRADE_LEDGER_SCHEMA:
+                    conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {TRADE_LEDGER_VERSION}")
+    return conn
+
+def trade_clock(reference):
+    #回傳 (上傳當天 0 點, 紀錄時間上限) 的秒數；reference 需為固定時差的本機時間，同一次上傳只計算一次
+    midnight = reference.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+    return midnight, reference.timestamp() + TRADE_CLOCK_SKEW.total_seconds()
+
+def trade_time(action, clock):
+    #回傳 (交易時間, 誤差) 秒數：紀錄時間減去 "x.x/h ago"，紀錄時間取上傳時間（本機時區）之前最近的同一時刻
+    midnight, latest = clock
+    hours, minutes, seconds = map(int, action["logged"].split(":"))
+    logged = midnight + hours * 3600 + minutes * 60 + seconds
+    if logged > latest:
+        logged -= 86400
+    value, unit = action["ago"].split("/")
+    return round(logged - float(value) * TRADE_AGE_UNITS[unit]), TRADE_AGE_UNITS[unit] // 10
+
+def matched_trade_rows(rows, stored):
+    #同一 (玩家, 物品, 數量) 的新動作與先前上傳的動作依時間一對一配對，時間差不超過兩者誤差總和視為同一筆交易
+    #同一份紀錄內重複的動作各自是一筆交易，不互相配對；回傳 {rows 索引: 配對到的動作 id}
+    grouped = {}
+    for index, row in enumerate(rows):
+        grouped.setdefault((row[5], row[6], row[7]), []).append(index)
+    matched = {}
+    for key, indices in grouped.items():
+        candidates = sorted(stored.get(key, ()))
+        used = [False] * len(candidates)
+        start = 0
+        for index in sorted(indices, key=lambda index: rows[index][3]):
+            traded_at, tolerance = rows[index][3], rows[index][4]
+            while start < len(candidates) and (used[start] or candidates[start][0] + candidates[start][1] + TRADE_MAX_TOLERANCE < traded_at):
+                start += 1
+            for position in range(start, len(candidates)):
+                stored_at, stored_tolerance, action_id = candidates[position]
+                if stored_at - stored_tolerance - TRADE_MAX_TOLERANCE > traded_at:
+                    break
+                if not used[position] and abs(stored_at - traded_at) <= stored_tolerance + tolerance:
+                    used[position] = True
+                    matched[index] = action_id
+                    break
+    return matched
+
+#解析中的交易動作先寫入連線專用的暫存表（存放在暫存檔，不佔記憶體），整份紀錄讀完才配對並寫入交易帳本
+#page 為 NULL 表示還沒讀到所屬的頁碼
+TRADE_STAGING_SCHEMA = [
+    """CREATE TEMP TABLE trade_staging (
+        id INTEGER PRIMARY KEY,
+        coord TEXT NOT NULL,
+        page INTEGER,
+        traded_at INTEGER NOT NULL,
+        tolerance INTEGER NOT NULL,
+        user TEXT NOT NULL,
+        item TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        duplicate_of INTEGER
+    )""",
+    "CREATE INDEX temp.trade_staging_coord ON trade_staging (coord)"
+]
+#配對用的索引在整份紀錄讀完後才建立，解析時的寫入只需要維護座標索引
+TRADE_STAGING_MATCH_SCHEMA = [
+    "CREATE INDEX temp.trade_staging_time ON trade_staging (coord, traded_at, page, id)",
+    "CREATE INDEX temp.trade_staging_duplicate ON trade_staging (duplicate_of) WHERE duplicate_of IS NOT NULL"
+]
+
+def match_staged_trades(conn, coord, batch_size):
+    #依交易時間每次取 batch_size 筆暫存的交易動作，與先前上傳、尚未被這次上傳配對過的交易配對，結果寫回 duplicate_of
+    #配對順序與一次取出整個座標相同（時間相同時依頁面順序、紀錄順序）
+    after = (-1 << 63, -1, -1)
+    while True:
+        rows = conn.execute(
+            "SELECT id, coord, page, traded_at, tolerance, user, item, count FROM temp.trade_staging "
+            "WHERE coord = ? AND (traded_at, page, id) > (?, ?, ?) ORDER BY traded_at, page, id LIMIT ?", (coord, *after, batch_size)
+        ).fetchall()
+        if not rows:
+            return
+        after = (rows[-1][3], rows[-1][2], rows[-1][0])
+        stored = {}
+        for action_id, traded_at, tolerance, user, item, count in conn.execute(
+            "SELECT id, traded_at, tolerance, user, item, count FROM trade_actions AS stored "
+            "WHERE coord = ? AND traded_at BETWEEN ? AND ? AND duplicate_of IS NULL "
+            "AND NOT EXISTS (SELECT 1 FROM temp.trade_staging AS used WHERE used.duplicate_of = stored.id)",
+            (coord, rows[0][3] - 2 * TRADE_MAX_TOLERANCE, rows[-1][3] + 2 * TRADE_MAX_TOLERANCE)
+        ):
+            stored.setdefault((user, item, count), []).append((traded_at, tolerance, action_id))
+        matched = matched_trade_rows(rows, stored)
+        conn.executemany("UPDATE temp.trade_staging SET duplicate_of = ? WHERE id = ?", [(action_id, rows[index][0]) for index, action_id in matched.items()])
+
+@timed("ingest_trade_log")
+def ingest_trade_log(lines, reference=None, path=TRADE_LEDGER_PATH, batch_size=TRADE_BATCH_SIZE):
+    #逐行解析交易紀錄並寫入交易帳本，先前上傳過的標記為重複、超過保留期限的略過
+    #回傳 (上傳 id, {座標: (頁數, 新增數, 略過數)}, 最後的偵測模式)；reference 為上傳時間（discord 訊息時間），用來推算紀錄行的日期
+    #交易動作讀到所屬的頁碼時寫入暫存表，等待頁碼的交易動作最多在記憶體保留 batch_size 筆，記憶體不隨紀錄行數增加
+    reference = (reference or datetime.now(timezone.utc)).astimezone()
+    cutoff = reference.timestamp() - TRADE_LEDGER_RETENTION_DAYS * 86400 if TRADE_LEDGER_RETENTION_DAYS > 0 else None
+    clock = trade_clock(reference)
+    state = {}
+    positions = {}
+    pending = {}
+    buffered = 0
+    unpaged = set()
+    stats = {}
+    with closing(open_trade_ledger(path)) as conn:
+        for statement in TRADE_STAGING_SCHEMA:
+            conn.execute(statement)
+        #暫存表只屬於這條連線，解析期間不需要鎖定交易帳本；整段解析在同一個交易內，不必每次寫入都提交
+        conn.execute("BEGIN")
+        for coord, regexResult in segment_trade_log(lines, state):
+            positions.setdefault(coord, {})
+            if isinstance(regexResult, dict):
+                pending.setdefault(coord, []).append((str(coord), *trade_time(regexResult, clock), regexResult["user"], regexResult["item"], regexResult["count"] * regexResult["action"]))
+                buffered += 1
+                if buffered >= batch_size:
+                    #還沒讀到頁碼的交易動作先以 page = NULL 寫入
+                    conn.executemany(
+                        "INSERT INTO temp.trade_staging (coord, traded_at, tolerance, user, item, count) VALUES (?, ?, ?, ?, ?, ?)",
+                        [row for rows in pending.values() for row in rows]
+                    )
+                    unpaged.update(pending)
+                    pending.clear()
+                    buffered = 0
+            elif isinstance(regexResult, tuple) and regexResult[0] > 0:
+                #重複的頁碼以後出現者為準，但維持第一次出現的頁面順序
+                if regexResult[0] in positions[coord]:
+                    conn.execute("DELETE FROM temp.trade_staging WHERE coord = ? AND page = ?", (str(coord), positions[coord][regexResult[0]]))
+                position = positions[coord].setdefault(regexResult[0], len(positions[coord]))
+                if coord in unpaged:
+                    conn.execute("UPDATE temp.trade_staging SET page = ? WHERE coord = ? AND page IS NULL", (position, str(coord)))
+                    unpaged.discard(coord)
+                rows = pending.pop(coord, [])
+                buffered -= len(rows)
+                conn.executemany(
+                    "INSERT INTO temp.trade_staging (coord, page, traded_at, tolerance, user, item, count) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(row[0], position, *row[1:]) for row in rows]
+                )
+        #最後一個頁碼之後的交易動作不屬於任何一頁
+        conn.execute("DELETE FROM temp.trade_staging WHERE page IS NULL")
+        for statement in TRADE_STAGING_MATCH_SCHEMA:
+            conn.execute(statement)
+        conn.execute("COMMIT")
+
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if cutoff is not None:
+                conn.execute("DELETE FROM trade_actions WHERE traded_at < ?", (cutoff,))
+                conn.execute("DELETE FROM trade_uploads WHERE uploaded_at < ?", (cutoff,))
+            upload = conn.execute("INSERT INTO trade_uploads (uploaded_at) VALUES (?)", (round(reference.timestamp()),)).lastrowid
+            for coord, pages in positions.items():
+                expired = conn.execute("DELETE FROM temp.trade_staging WHERE coord = ? AND traded_at < ?", (str(coord), cutoff)).rowcount if cutoff is not None else 0
+                match_staged_trades(conn, str(coord), batch_size)
+                fresh, duplicates = conn.execute(
+                    "SELECT COUNT(*) - COUNT(duplicate_of), COUNT(duplicate_of) FROM temp.trade_staging WHERE coord = ?", (str(coord),)
+                ).fetchone()
+                conn.execute(
+                    "INSERT INTO trade_actions (coord, upload, page, traded_at, tolerance, user, item, count, duplicate_of) "
+                    "SELECT coord, ?, page, traded_at, tolerance, user, item, count, duplicate_of FROM temp.trade_staging WHERE coord = ? ORDER BY page, id",
+                    (upload, str(coord))
+                )
+                stats[coord] = (len(pages), fresh, duplicates + expired)
+        conn.execute("DROP TABLE temp.trade_staging")
+    return upload, stats, state.get("auto_detect", False)
+
+def load_upload_pages(upload, page_counts, path=TRADE_LEDGER_PATH):
+    #回傳這次上傳中先前未處理過的交易：{座標: {頁面順序: [交易動作]}}，page_counts 為 {座標: 頁數}
+    #同一頁的 (玩家, 物品) 在資料庫中先加總，依第一次出現的順序排列，加總後的結果與逐筆計算相同
+    trade_pages = {coord: {page: [] for page in range(count)} for coord, count in page_counts.items()}
+    coords = {str(coord): coord for coord in page_counts}
+    with closing(open_trade_ledger(path)) as conn:
+        for coord, page, user, item, total in conn.execute(
+            "SELECT coord, page, user, item, SUM(count) FROM trade_actions WHERE upload = ? AND duplicate_of IS NULL "
+            "GROUP BY coord, page, user, item ORDER BY MIN(id)", (upload,)
+        ):
+            trade_pages[coords[coord]][page].append({"user": user, "item": item, "count": total, "action": 1})
+    return trade_pages
+
+def load_trade_ledger(coord, ignore, nbt, path=TRADE_LEDGER_PATH):
+    #從資料庫回傳與 build_trade_ledger 相同格式的累計帳本（保留期限內的所有上傳），直接讀取增量維護的累計數量
+    ignored = TRADE_IGNORE_LIST if ignore else ()
+    with closing(open_trade_ledger(path)) as conn:
+        if nbt != "":
+            #nbt 篩選取決於頁面順序，無法預先加總，依序重播每次上傳的每一頁
+            pages = {}
+            for upload, page, user, item, count in conn.execute(
+                "SELECT upload, page, user, item, count FROM trade_actions WHERE coord = ? AND duplicate_of IS NULL ORDER BY upload, page, id", (str(coord),)
+            ):
+                pages.setdefault((upload, page), []).append({"user": user, "item": item, "count": count, "action": 1})
+            return build_trade_ledger(pages, ignore, nbt)
+        rows = conn.execute("SELECT user, item, total FROM trade_balances WHERE coord = ? ORDER BY rowid", (str(coord),)).fetchall()
+    #玩家依第一次出現排序，同一玩家的物品維持出現順序
+    user_ids, item_ids, grouped = {}, {}, {}
+    for user, item, total in rows:
+        if user in ignored:
+            continue
+        user_id = user_ids.setdefault(user, len(user_ids))
+        grouped.setdefault(user_id, []).append((item_ids.setdefault(item, len(item_ids)), total))
+    pairs = [(user_id, item_id, total) for user_id, user_pairs in grouped.items() for item_id, total in user_pairs]
+    pair_users, pair_items, totals = (np.array(column, dtype=np.int64) for column in zip(*pairs)) if pairs else (np.zeros(0, dtype=np.int64),) * 3
+    return {"users": list(user_ids), "items": list(item_ids), "pair_users": pair_users, "pair_items": pair_items, "totals": totals}
+
+# ----------------- PIG 會員名單 -----------------
+PIG_VIP_PATH = "pig_vip.json"
+PIG_VIP_CHECK_INTERVAL = 1.0
+#members 為查詢用的 frozenset，roster 保留檔案中的順序，每次重新載入或寫入 version 加一
+pig_vip_store = {"mtime": None, "checked": None, "version": 0, "members": frozenset(), "roster": ()}
+
+def set_pig_vip(roster, mtime):
+    pig_vip_store.update(
+        mtime=mtime,
+        checked=time.monotonic(),
+        version=pig_vip_store["version"] + 1,
+        members=frozenset(roster),
+        roster=tuple(roster)
+    )
+
+def load_pig_vip(path=PIG_VIP_PATH):
+    #回傳會員 frozenset；最多每秒檢查一次修改時間，檔案被外部修改時才重新讀取
+    checked = pig_vip_store["checked"]
+    if checked is None or time.monotonic() - checked >= PIG_VIP_CHECK_INTERVAL:
+        mtime = os.stat(path).st_mtime_ns
+        if pig_vip_store["mtime"] != mtime:
+            with open(path, "r", encoding="utf-8") as f:
+                set_pig_vip(json.load(f)["PIG"], mtime)
+        else:
+            pig_vip_store["checked"] = time.monotonic()
+    return pig_vip_store["members"]
+
+def save_pig_vip(roster, path=PIG_VIP_PATH):
+    #先寫入暫存檔再 rename，寫入後直接更新記憶體快照
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump({"PIG": roster}, f, ensure_ascii=False, indent=4)
+    os.replace(temp_path, path)
+    set_pig_vip(roster, os.stat(path).st_mtime_ns)
+
+def handle_trade_pages(message, filtered, coord, auto_detect, report, ledger_path=None):
+    #結果依序寫入呼叫端傳入的 report（ReportBuilder 或任何有 write 的物件），不另外組合成字串
     CURRENCYMAP = {
     "experience_bottle": "<:xp:1397875984484798475> XP",
     "dragon_breath": "<:cxp:1397875964796469389> CXP",
@@ -348,49 +1590,37 @@ def handle_trade_log(message, file_lines, coord, auto_detect):
     "firework_star": "<:har:1397875820386848852> HAR"
 }
     CURRENCY_VALUE = {"XP":1, "CXP":64, "HXP":64**2, "CS":1, "CCS":64, "HCS":64**2, "AR":64, "HAR":64**2}
-    final_message = ""
-    filtered = {}
     shop_name = "未知商店"
+    shop_heading = shop_name
     parameter = check_parameter(message)
-    #過濾訊息
-    pageDataTemp = []
-    for lines in file_lines:
-        regexResult = regular_expression(lines)
-        if isinstance(regexResult, dict):
-            pageDataTemp.append(regexResult)
-        elif isinstance(regexResult, tuple) and regexResult[0] > 0:
-            pageNumber = regexResult[0]
-            maxPageNumber = regexResult[1]
-            filtered.update({pageNumber:pageDataTemp})
-            pageDataTemp = []
-    
-    # 讀取 barrel_data.json
-    with open("barrel_data.json", "r", encoding="utf-8") as f:
-        raw_data = json.load(f)
-        barrel_data = {}
-    
-    for key_str, value in raw_data.items():
-        key_tuple = ast.literal_eval(key_str)
-        barrel_data[key_tuple] = value
-    
-    #範圍查找模式自動隱藏非資料庫座標
+
+    # 讀取 barrel_data.json（已快取）
+    barrel_data = load_barrel_data()
+    barrel_coord = coord
+    #範圍查找模式：座標差一兩格、附近只有一個登記木桶時對應到該座標
     if coord not in barrel_data and auto_detect:
-        return final_message, auto_detect
+        barrel_coord = find_nearest_barrel(coord)
+
+    #範圍查找模式自動隱藏非資料庫座標
+    if barrel_coord is None:
+        return auto_detect
 
     # 從barrel_data中取得商店價格
-    if barrel_data.get(coord, False):
-        parameter["buyPrice"] = barrel_data[coord]["buyPrice"]
-        parameter["sellPrice"] = barrel_data[coord]["sellPrice"]
-        parameter["unit"] = barrel_data[coord]["unit"]
+    if barrel_data.get(barrel_coord, False):
+        parameter["buyPrice"] = barrel_data[barrel_coord]["buyPrice"]
+        parameter["sellPrice"] = barrel_data[barrel_coord]["sellPrice"]
+        parameter["unit"] = barrel_data[barrel_coord]["unit"]
         parameter["ignore_correct_trade"] = True
         parameter["ignore_owner"] = True
         auto_detect = True
-        shop_name = barrel_data[coord]["name"]
+        shop_name = barrel_data[barrel_coord]["name"]
+        shop_heading = shop_name
+        #近似座標只標示在給管理員看的標題，給玩家的訊息使用原本的商店名稱
+        if barrel_coord != coord:
+            shop_heading += f" (≈{barrel_coord})"
     
-    #開啟 PIG 會員名單
-    with open("pig_vip.json", "r", encoding="utf-8") as f:
-        vip_data = json.load(f)
-    pig_vip = vip_data["PIG"]
+    #PIG 會員名單（記憶體快照）
+    pig_vip = load_pig_vip()
 
     #計算結果
     if filtered:
@@ -402,17 +1632,14 @@ def handle_trade_log(message, file_lines, coord, auto_detect):
         f'└ 忽略正確交易(Ignore Correct Trade): {parameter["ignore_correct_trade"]} \n'
         f'└ NBT 標籤(NBT tag): {parameter["nbt"] if parameter["nbt"] else "無 (None)"} \n')
         if not auto_detect:
-            for paramater_setting_message_line in split_log_result(("<:ghost_technology_4:1293185676086481039> 參數未提供或格式錯誤，使用預設參數。\n" if (parameter["buyPrice"] == None) else "") + '<:ghost_technology:1292853415465975849> 正在計算交易結果...\n' + "⚠️ 注意：某些物品 (如 nether_star) 同時作為貨幣與商品使用，建議手動確認 NBT 或交易內容以避免誤判。\n" + parameter_setting):
-                final_message += paramater_setting_message_line + "\n"
-        playerLog = {}
-        #pageResult = ""
-        for pageNumber, pageData in filtered.items():
-            result = check_changed_item(pageData, playerLog, parameter["ignore_owner"], parameter["nbt"])
-            playerLog = result[1]
-            #pageResult += ("📄 以下是第**" + str(pageNumber) + "/" + str(maxPageNumber) + "**頁的結果: \n" + result[0])
-        #for log in split_log_result(pageResult):
-            #await message.channel.send(log)
-        logResult = ""
+            report.write(("<:ghost_technology_4:1293185676086481039> 參數未提供或格式錯誤，使用預設參數。\n" if (parameter["buyPrice"] == None) else "") + '<:ghost_technology:1292853415465975849> 正在計算交易結果...\n' + "⚠️ 注意：某些物品 (如 nether_star) 同時作為貨幣與商品使用，建議手動確認 NBT 或交易內容以避免誤判。\n" + parameter_setting + "\n")
+        #有帳本資料庫時以累計資料計算（包含先前上傳過的紀錄）
+        if ledger_path:
+            ledger = load_trade_ledger(coord, parameter["ignore_owner"], parameter["nbt"], ledger_path)
+        else:
+            ledger = build_trade_ledger(filtered, parameter["ignore_owner"], parameter["nbt"])
+        playerLog = ledger_player_log(ledger)
+        logResult = []
         mistradeMessage = ""
         wrongPayment = {}
         wrongUsage = {}
@@ -423,7 +1650,7 @@ def handle_trade_log(message, file_lines, coord, auto_detect):
         vip_in_log = []
         #建立錯誤交易名單
         if parameter["buyPrice"] != None:
-            wrongPayment, wrongUsage, changedProductCountForPlayer = mistrade_calculator(playerLog, parameter["unit"], parameter["buyPrice"], parameter["sellPrice"])
+            wrongPayment, wrongUsage, changedProductCountForPlayer = mistrade_calculator(ledger, parameter["unit"], parameter["buyPrice"], parameter["sellPrice"])
         for playerName, changedItems in playerLog.items():
             fixedName = playerName.replace("_", "\\_")
             players_in_log.append(fixedName)
@@ -439,8 +1666,8 @@ def handle_trade_log(message, file_lines, coord, auto_detect):
                         mistradeMessage +=  f"@{fixedName} 多支付了 (overpaid) {wrongPayment[playerName]} {parameter['unit']} \n"
                     elif wrongPayment[playerName] < 0:
                         mistradeMessage += f"@{fixedName} 欠了 (underpaid) {-wrongPayment[playerName]} {parameter['unit']} \n"
-                    #判斷錯誤金額是否 > 1H
-                    if -wrongPayment[playerName] * CURRENCY_VALUE[parameter["unit"].upper()] >= 64 ** 2:
+                    #判斷錯誤金額是否 > 1H；近似座標可能是另一個木桶，不產生給玩家的付款通知
+                    if -wrongPayment[playerName] * CURRENCY_VALUE[parameter["unit"].upper()] >= 64 ** 2 and barrel_coord == coord:
                         buy_price = str(parameter["buyPrice"]) + parameter["unit"].upper()
                         sell_price = str(parameter["sellPrice"]) + parameter["unit"].upper()
                         took_product = changedProductCountForPlayer[playerName]
@@ -455,60 +1682,338 @@ def handle_trade_log(message, file_lines, coord, auto_detect):
                 #是否顯示正確交易者
                 if parameter["ignore_correct_trade"]:
                     if userMistraded:
-                        logResult += ":warning: <:ghost_technology_5:1293185945461461013> " + "**" + fixedName + "**: \n"
+                        logResult.append(":warning: <:ghost_technology_5:1293185945461461013> " + "**" + fixedName + "**: \n")
                     else:
                         hidden_correct_trade_count += 1
                 else:
-                    logResult += (":warning: <:ghost_technology_5:1293185945461461013> " if userMistraded else "") + "**" + fixedName + "**: \n"
+                    logResult.append((":warning: <:ghost_technology_5:1293185945461461013> " if userMistraded else "") + "**" + fixedName + "**: \n")
                     
                 for itemName, count in changedItems.items():
                     if count != 0 and not (parameter["ignore_correct_trade"] and not userMistraded):
-                        logResult += " └ " + CURRENCYMAP.get(itemName, " ".join(word.capitalize() for word in itemName.split("_"))) + " " + str(count) + "\n"
+                        logResult.append(" └ " + CURRENCYMAP.get(itemName, " ".join(word.capitalize() for word in itemName.split("_"))) + " " + str(count) + "\n")
                 if userMistraded:
-                    logResult += "\n" + mistradeMessage
-                    logResult += "\n"
-        if logResult == "": logResult = "<:ghost_technology_4:1293185676086481039> 物品無變動 (No item changes were made)\n"
-        if hidden_correct_trade_count > 0: logResult += f"✅ 共有 {hidden_correct_trade_count} 筆正確交易被隱藏 (Correct trade entries were hidden)\n"
+                    logResult.append("\n" + mistradeMessage + "\n")
+        if not logResult: logResult.append("<:ghost_technology_4:1293185676086481039> 物品無變動 (No item changes were made)\n")
+        if hidden_correct_trade_count > 0: logResult.append(f"✅ 共有 {hidden_correct_trade_count} 筆正確交易被隱藏 (Correct trade entries were hidden)\n")
         
         if len(players_in_log) > 0:
-            logResult += f"✅ 共有 {len(players_in_log)} 個玩家參與交易 (Players participated in the trade):\n"
-            logResult += " ".join(players_in_log)
-            logResult += "\n"
+            logResult.append(f"✅ 共有 {len(players_in_log)} 個玩家參與交易 (Players participated in the trade):\n")
+            logResult.append(" ".join(players_in_log) + "\n")
         if len(vip_in_log) > 0:
-            logResult += f"✅ 共有 {len(vip_in_log)} 個會員參與交易 (Vips participated in the trade):\n"
-            logResult += " ".join(vip_in_log)
-            logResult += "\n"
+            logResult.append(f"✅ 共有 {len(vip_in_log)} 個會員參與交易 (Vips participated in the trade):\n")
+            logResult.append(" ".join(vip_in_log) + "\n")
         
         auto_detect = "[Auto]" if auto_detect else ""
         buy_price = str(parameter["buyPrice"]) + parameter["unit"].upper()
         sell_price = str(parameter["sellPrice"]) + parameter["unit"].upper()
-        for log in split_log_result(f"# **{shop_name} {coord} {auto_detect}** \n **買價(Buy Price): {buy_price}** \n **賣價(Sell Price): {sell_price}** \n {logResult}"):
-            final_message += log + "\n"
+        report.write(f"# **{shop_heading} {coord} {auto_detect}** \n **買價(Buy Price): {buy_price}** \n **賣價(Sell Price): {sell_price}** \n ")
+        for fragment in logResult:
+            report.write(fragment)
+        report.write("\n")
+    else:
+        report.write(f'<:ghost_technology_4:1293185676086481039> 格式錯誤，應為{BOT_PREFIX}mistrade 紀錄(或.txt) <買價 賣價 單位 [忽略店主] [忽略正確交易] [尋找特定nbt]>\n')
+    return auto_detect
+
+# ----------------- 平行處理商店 -----------------
+#預設逐一處理；MISTRADE_WORKERS > 1 時才建立工作程序池
+MISTRADE_WORKERS = int(os.getenv("MISTRADE_WORKERS", "1"))
+#交易筆數達到此值才交給工作程序：每間商店只需約 0.1 ms，小紀錄的分派與傳輸成本比計算本身還高
+MISTRADE_POOL_MIN_ACTIONS = int(os.getenv("MISTRADE_POOL_MIN_ACTIONS", "200000"))
+#逐一處理時分段執行，每段完成後回報一次進度
+MISTRADE_PROGRESS_STEPS = 10
+mistrade_executor = None
+
+def plan_trade_shops(trade_pages, auto_detect):
+    #每間商店的自動模式只取決於前面是否出現過登記座標，先依序算好各商店的輸入，之後即可獨立處理
+    barrel_data = load_barrel_data()
+    jobs = []
+    for coord, pages in trade_pages.items():
+        jobs.append((coord, pages, auto_detect))
+        auto_detect = auto_detect or coord in barrel_data
+    return jobs
+
+def trade_job_size(job):
+    return 1 + sum(len(pageData) for pageData in job[1].values())
+
+def split_trade_jobs(jobs, count):
+    #依座標順序切成最多 count 段，每段的交易筆數大致相同
+    total = sum(map(trade_job_size, jobs))
+    slices = [[]]
+    size = 0
+    for job in jobs:
+        if slices[-1] and size >= total * len(slices) / count:
+            slices.append([])
+        slices[-1].append(job)
+        size += trade_job_size(job)
+    return slices
+
+def analyze_trade_slice(content, jobs, ledger_path=None):
+    #可能在工作程序執行：各商店寫入同一個字串緩衝區，整段的結果與各商店耗時一起傳回，由主程序寫入報告並記錄到 handle_trade_pages 指標
+    report = io.StringIO()
+    timings = []
+    for coord, pages, auto_detect in jobs:
+        start = time.perf_counter()
+        handle_trade_pages(content, pages, coord, auto_detect, report, ledger_path)
+        timings.append(time.perf_counter() - start)
+    return report.getvalue(), timings
+
+def collect_trade_slice(results):
+    text, timings = results
+    for elapsed in timings:
+        record_latency("handle_trade_pages", elapsed)
+    return text
+
+def get_mistrade_executor(jobs=None):
+    #MISTRADE_WORKERS <= 1 或交易筆數未達 MISTRADE_POOL_MIN_ACTIONS 時回傳 None（逐一處理）；free-threaded 版本改用執行緒池
+    global mistrade_executor
+    if MISTRADE_WORKERS <= 1 or (jobs is not None and sum(map(trade_job_size, jobs)) < MISTRADE_POOL_MIN_ACTIONS):
+        return None
+    if mistrade_executor is None:
+        if getattr(sys, "_is_gil_enabled", lambda: True)():
+            #bot 已有其他執行緒（discord.py、to_thread、指標鎖），fork 可能複製到被持有的鎖，改以 spawn 啟動工作程序
+            #spawn 的工作程序會重新匯入一次 bot.py（不會啟動 bot），工作程序池建立後持續重用
+            mistrade_executor = ProcessPoolExecutor(max_workers=MISTRADE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        else:
+            mistrade_executor = ThreadPoolExecutor(max_workers=MISTRADE_WORKERS)
+    return mistrade_executor
+
+def run_trade_shops(content, trade_pages, auto_detect, report, executor=None, ledger_path=None):
+    #依座標順序把各商店結果寫入 report，輸出與逐一處理完全相同
+    global mistrade_executor
+    jobs = plan_trade_shops(trade_pages, auto_detect)
+    slices = [jobs]
+    written = 0
+    if executor is not None and len(jobs) > 1:
+        #每個工作程序大約分到一段，減少分派次數
+        slices = split_trade_jobs(jobs, MISTRADE_WORKERS)
+        try:
+            for results in executor.map(analyze_trade_slice, [content] * len(slices), slices, [ledger_path] * len(slices)):
+                report.write(collect_trade_slice(results))
+                written += 1
+            return
+        except BrokenExecutor:
+            #工作程序意外結束：丟棄執行器，下次重新建立；已寫入的段落保留，剩下的段落改為逐一處理
+            if executor is mistrade_executor:
+                mistrade_executor = None
+    for job_slice in slices[written:]:
+        report.write(collect_trade_slice(analyze_trade_slice(content, job_slice, ledger_path)))
+
+@timed("analyze_trade_shops")
+async def analyze_trade_shops(content, trade_pages, auto_detect, report, progress=None, ledger_path=None):
+    #非同步版本：每完成一段商店就依座標順序寫入 report 並 await progress(完成商店數, 總數)，取消時一併取消尚未開始的段落
+    global mistrade_executor
+    jobs = plan_trade_shops(trade_pages, auto_detect)
+    executor = get_mistrade_executor(jobs)
+    if executor is None:
+        #逐一處理：在背景執行緒依序執行各段，不阻塞事件迴圈
+        slices = split_trade_jobs(jobs, MISTRADE_PROGRESS_STEPS)
+        futures = []
     else:
-        final_message += f'<:ghost_technology_4:1293185676086481039> 格式錯誤，應為{BOT_PREFIX}mistrade 紀錄(或.txt) <買價 賣價 單位 [忽略店主] [忽略正確交易] [尋找特定nbt]>\n'
-    return final_message, auto_detect
+        slices = split_trade_jobs(jobs, MISTRADE_WORKERS)
+        loop = asyncio.get_running_loop()
+        futures = [loop.run_in_executor(executor, analyze_trade_slice, content, job_slice, ledger_path) for job_slice in slices]
+    done = 0
+    try:
+        for index, job_slice in enumerate(slices):
+            try:
+                results = await (futures[index] if futures else asyncio.to_thread(analyze_trade_slice, content, job_slice, ledger_path))
+            except BrokenExecutor:
+                #工作程序意外結束：丟棄執行器，下次重新建立；已寫入的段落保留，這一段與剩下的段落改為逐一處理
+                if executor is mistrade_executor:
+                    mistrade_executor = None
+                for future in futures:
+                    future.cancel()
+                futures = []
+                results = await asyncio.to_thread(analyze_trade_slice, content, job_slice, ledger_path)
+            report.write(collect_trade_slice(results))
+            done += len(job_slice)
+            if progress is not None:
+                await progress(done, len(jobs))
+    finally:
+        for future in futures:
+            future.cancel()
+
+class ReportBuilder:
+    #逐段組合報告：片段先放進 list，每湊滿一段（不超過 limit 字）才 join 一次
+    #超過 limit 的單行會優先在空白處切開，不會產生超長訊息
+    #有 sink 時每完成一段就交給 sink（例如頻道送出佇列），不必等整份報告完成；沒有 sink 時由 finish() 回傳所有段落
+    def __init__(self, limit=2000, sink=None):
+        self.limit = limit
+        self.sink = sink
+        self.partial = []
+        self.lines = []
+        self.size = -1
+        self.chunks = []
+
+    def write(self, text):
+        if "\n" not in text:
+            self.partial.append(text)
+            return
+        pieces = text.split("\n")
+        self.partial.append(pieces[0])
+        self.add_line("".join(self.partial))
+        for line in pieces[1:-1]:
+            self.add_line(line)
+        self.partial = [pieces[-1]]
+
+    def add_line(self, line):
+        while len(line) > self.limit:
+            #在最後一個空白之後切開（空白留在前一段），沒有空白時直接切
+            cut = line.rfind(" ", 0, self.limit) + 1 or self.limit
+            self.add_line(line[:cut])
+            line = line[cut:]
+        if self.lines and self.size + 1 + len(line) > self.limit:
+            self.flush()
+        self.lines.append(line)
+        self.size += 1 + len(line)
+
+    def flush(self):
+        chunk = "\n".join(self.lines)
+        if chunk and self.sink is not None:
+            self.sink(chunk)
+        elif chunk:
+            self.chunks.append(chunk)
+        self.lines = []
+        self.size = -1
+
+    def finish(self):
+        self.add_line("".join(self.partial))
+        self.partial = []
+        self.flush()
+        return self.chunks
 
 def split_log_result(log_result: str, limit: int = 2000):
-    lines = log_result.split('\n')
+    report = ReportBuilder(limit)
+    report.write(log_result)
+    return report.finish()
+
+class AttachmentReport:
+    #過長的報告改以附件送出：原始文字全部保留給附件（不經過 2000 字切段），前 threshold 字同時寫入 stream 逐段送出
+    def __init__(self, stream, threshold):
+        self.stream = stream
+        self.threshold = threshold
+        self.fragments = []
+        self.length = 0
+
+    def write(self, text):
+        #跨過 threshold 的片段只寫入前面的部分；超過後 stream 不會 finish，未完成的最後一行不會送出
+        if self.length < self.threshold:
+            self.stream.write(text[:self.threshold - self.length])
+        self.fragments.append(text)
+        self.length += len(text)
+
+    def overflowed(self):
+        return self.length > self.threshold
+
+    def text(self):
+        return "".join(self.fragments)
+
+CUSTOM_EMOJI_PATTERN = re.compile(r'<a?:(\w+):\d+>')
+
+def build_report_attachment(report):
+    #附件以 :名稱: 取代 Discord 自訂表情，下載後用一般編輯器也容易閱讀
+    return io.BytesIO(CUSTOM_EMOJI_PATTERN.sub(r':\1:', report).encode("utf-8"))
+
+# ----------------- 訊息送出佇列 -----------------
+DISCORD_MESSAGE_LIMIT = 2000
+DISCORD_EMBED_DESCRIPTION_LIMIT = 4096
+DISCORD_EMBEDS_TOTAL_LIMIT = 6000
+DISCORD_EMBEDS_PER_MESSAGE = 10
+MESSAGE_COALESCE_DELAY = 0.05
+MESSAGE_SEND_RETRIES = 4
+MESSAGE_RETRY_DELAY = 1.0
+
+def pack_text_messages(chunks):
+    #相鄰的文字合併成一則訊息；放不進 2000 字時改用 embed，每則訊息最多 10 個 embed、合計 6000 字
+    chunks = [chunk for chunk in chunks if chunk]
+    if not chunks:
+        return []
+    joined = "\n".join(chunks)
+    if len(joined) <= DISCORD_MESSAGE_LIMIT:
+        return [{"content": joined}]
     messages = []
-    current_message = ""
-
-    for line in lines:
-
-        if len(current_message) + len(line) + 1 > limit:
-            messages.append(current_message)
-            current_message = line
-        else:
-            if current_message:
-                current_message += '\n' + line
-            else:
-                current_message = line
-
-    # 加入最後一段訊息
-    if current_message:
-        messages.append(current_message)
-
-    return messages
+    embeds = []
+    used = 0
+    description = ""
+    for chunk in chunks:
+        candidate = description + "\n" + chunk if description else chunk
+        if len(candidate) <= DISCORD_EMBED_DESCRIPTION_LIMIT and used + len(candidate) <= DISCORD_EMBEDS_TOTAL_LIMIT:
+            description = candidate
+            continue
+        if description:
+            embeds.append(description)
+            used += len(description)
+        if used + len(chunk) > DISCORD_EMBEDS_TOTAL_LIMIT or len(embeds) == DISCORD_EMBEDS_PER_MESSAGE:
+            messages.append(embeds)
+            embeds = []
+            used = 0
+        description = chunk
+    embeds.append(description)
+    messages.append(embeds)
+    return [{"embeds": [discord.Embed(description=text) for text in group]} for group in messages]
+
+class ChannelSender:
+    #每個頻道一個送出佇列，呼叫端放入訊息後立即返回，由背景工作依序送出，同一份報告的段落合併成較少的訊息
+    #速率限制的 bucket 標頭由 discord.py 處理，仍失敗 (429 / 5xx) 時在這裡指數退避重試
+    def __init__(self, channel):
+        self.channel = channel
+        self.pending = deque()
+        self.task = None
+
+    def enqueue(self, content=None, batch=None, **kwargs):
+        #只合併同一批 (batch) 的文字訊息，不同工作或使用者的回覆不會併在一起；batch 為 None 時自成一批
+        #帶附件等參數的訊息單獨送出
+        self.pending.append((content, kwargs, object() if batch is None else batch))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def report(self, limit=DISCORD_MESSAGE_LIMIT):
+        #回傳串流報告：寫入的內容每湊滿一段就放進佇列，同一份報告的段落屬於同一批；寫完後呼叫 finish() 送出最後一段
+        #只能在事件迴圈的執行緒寫入
+        batch = object()
+        return ReportBuilder(limit, lambda chunk: self.enqueue(chunk, batch))
+
+    def next_payloads(self):
+        content, kwargs, batch = self.pending.popleft()
+        if kwargs:
+            return [dict(kwargs, content=content)]
+        chunks = [content]
+        while self.pending and not self.pending[0][1] and self.pending[0][2] is batch:
+            chunks.append(self.pending.popleft()[0])
+        return pack_text_messages(chunks)
+
+    async def run(self):
+        while self.pending:
+            #稍等一下，讓同一份報告接著放入的段落一起合併
+            await asyncio.sleep(MESSAGE_COALESCE_DELAY)
+            for payload in self.next_payloads():
+                await self.send(payload)
+        #佇列清空後移除，閒置頻道不會一直留在 channel_senders
+        if channel_senders.get(self.channel.id) is self:
+            del channel_senders[self.channel.id]
+
+    @timed("discord_send")
+    async def send(self, payload):
+        #附件送出後會被 discord.py 關閉，無法由這裡重送
+        for attempt in range(1 if "file" in payload else MESSAGE_SEND_RETRIES):
+            try:
+                return await self.channel.send(**payload)
+            except discord.HTTPException as e:
+                if e.status != 429 and e.status < 500:
+                    print(f"⚠️ 無法送出訊息：{e}")
+                    return None
+                await asyncio.sleep(MESSAGE_RETRY_DELAY * 2 ** attempt)
+        print("⚠️ 訊息重試次數已達上限，放棄送出")
+        return None
+
+#只保留還有訊息待送的頻道
+channel_senders = {}
+
+def channel_sender(channel):
+    sender = channel_senders.get(channel.id)
+    if sender is None:
+        sender = channel_senders[channel.id] = ChannelSender(channel)
+    return sender
 
 def get_full_class_name(class_name: str) -> str:
     class_tree = {
@@ -570,7 +2075,9 @@ def display_skill_grid(skillpoint):
         result += row + "\n"
     return result
 
-def manage_build(buildCommand, sender):
+@timed("manage_build")
+def manage_build(buildCommand, sender, report):
+    #回覆寫入呼叫端傳入的 report（例如 ChannelSender.report()），由呼叫端決定何時 finish()
     # 解析名稱與連結
     if len(buildCommand) >= 3:
         build_name = buildCommand[2]
@@ -580,7 +2087,8 @@ def manage_build(buildCommand, sender):
         #檢查連結是否合法
         parsed = urlparse(build_link)
         if not parsed.netloc in ["odetomisery.vercel.app", "ohthemisery-psi.vercel.app"] or parsed.scheme != "https":
-            return "build連結錯誤"
+            report.write("build連結錯誤")
+            return
         
         # 建立新的 build 資料
         new_build = {
@@ -605,22 +2113,26 @@ def manage_build(buildCommand, sender):
             data.update(new_build)
             op = "儲存"
         else:
-            return "存在相同名稱build!"
+            report.write("存在相同名稱build!")
+            return
 
     # 刪除舊的 build 資料
     elif buildCommand[1] == "remove":
         with open("build.json", "r", encoding="utf-8") as f:
             data = json.load(f)
         if not os.path.exists("build.json"):
-            return "❌ 找不到 build.json 檔案。"
+            report.write("❌ 找不到 build.json 檔案。")
+            return
         if build_name in data:
             if data[build_name]["作者"] == sender:
                 del data[build_name]
                 op = "刪除"
             else:
-                return f"⛔ {sender} 不是作者。"
+                report.write(f"⛔ {sender} 不是作者。")
+                return
         else:
-            return f"⚠️ 沒有找到名稱為「{build_name}」的 build。"
+            report.write(f"⚠️ 沒有找到名稱為「{build_name}」的 build。")
+            return
     
     #搜尋已存在build
     elif (buildCommand[1] == "find" and len(buildCommand) >= 3) or buildCommand[1] == "own":
@@ -637,11 +2149,12 @@ def manage_build(buildCommand, sender):
             elif buildCommand[1] == "own" and info["作者"] == sender:
                 matched.append((name, info))
         if not matched:
-            return "🔍 沒有找到符合的 build 。"
+            report.write("🔍 沒有找到符合的 build 。")
+            return
         else:
             top_results = matched[:5]
-            # 建立結果訊息
-            result_lines = ["🔎 找到以下符合的 build："]
+            # 建立結果訊息：每個 build 完成後就寫入報告
+            report.write("🔎 找到以下符合的 build：")
             hasClass = False
             for name, info in top_results:
                 for a, b in info.items():
@@ -653,8 +2166,8 @@ def manage_build(buildCommand, sender):
                     skillPoints = ""
                     className = ""
                 name_without_emoji = emoji.replace_emoji(name, replace='')
-                result_lines.append(
-                    f"# **{name}**\n"
+                report.write(
+                    f"\n# **{name}**\n"
                     f"└🔗 連結：[{name_without_emoji}]({info['連結']})\n"
                     f"└👤 作者：{info['作者']}\n"
                     f"{className}"
@@ -662,26 +2175,30 @@ def manage_build(buildCommand, sender):
                     f"└🗒️ 資訊：{info.get('資訊', '（無）')}"
                 )
 
-            return "\n".join(result_lines)
+            return
 
     #修改職業/技能點
     elif buildCommand[1] == "setclass" and len(buildCommand) >= 4:
         setClass = get_full_class_name(buildCommand[3].capitalize())
         if not setClass:
-            return f"⚠️ 職業名稱錯誤!"
+            report.write(f"⚠️ 職業名稱錯誤!")
+            return
         if len(buildCommand) >= 5:
             skillPoints = buildCommand[4]
             classSkillPoints = skillPoints[:8]
             specSkillPoints = skillPoints[8:11]
             #判斷書入點數是否合法
             if len(skillPoints) != 8 and len(skillPoints) != 11:
-                return f"⚠️ 技能點數量錯誤!"
+                report.write(f"⚠️ 技能點數量錯誤!")
+                return
             for pt in classSkillPoints:
                 if pt not in ["0", "1", "2", "3", "4"]:
-                    return f"⚠️ 一般技能點只能為 0/1/2/3"
+                    report.write(f"⚠️ 一般技能點只能為 0/1/2/3")
+                    return
             for pt in specSkillPoints:
                 if pt not in ["0", "1", "2"]:
-                    return f"⚠️ 二轉技能點只能為 0/1/2"
+                    report.write(f"⚠️ 二轉技能點只能為 0/1/2")
+                    return
         else:
             classSkillPoints = "00000000"
             specSkillPoints = "000"
@@ -695,46 +2212,42 @@ def manage_build(buildCommand, sender):
                     op = "修改"
                     data[buildName] = {k: v for k, v in data[buildName].items() if k in ["連結", "作者", "資訊", setClass]}
                 else:
-                    return f"⛔ {sender} 不是作者。"
+                    report.write(f"⛔ {sender} 不是作者。")
+                    return
             else:
-                return f"⚠️ 沒有找到名稱為「{buildName}」的 build。"
+                report.write(f"⚠️ 沒有找到名稱為「{buildName}」的 build。")
+                return
 
     else:
-        return f"<:ghost_technology_4:1293185676086481039> 指令格式錯誤!"
+        report.write(f"<:ghost_technology_4:1293185676086481039> 指令格式錯誤!")
+        return
     # 寫回 JSON 檔案
     with open("build.json", "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=4)
 
     if op == "儲存":
-        return f"✅ 已成功{op}Build「 [{build_name}]({build_link}) 」！"
+        report.write(f"✅ 已成功{op}Build「 [{build_name}]({build_link}) 」！")
     elif op == "刪除":
-        return f"✅ 已成功{op}Build「 {build_name} 」！"
+        report.write(f"✅ 已成功{op}Build「 {build_name} 」！")
     elif op == "修改":
-        return f"✅ 已成功{op}Build「 {build_name} 」的職業！"
+        report.write(f"✅ 已成功{op}Build「 {build_name} 」的職業！")
     
 def manage_pig_vip(action, user = ""):
-    #開啟 JSON 檔案
-    with open("pig_vip.json", "r", encoding="utf-8") as f:
-        vip_data = json.load(f)
-    
-    pig_vip = vip_data["PIG"]
-    
+    pig_vip = load_pig_vip()
+    roster = list(pig_vip_store["roster"])
+
     if action == "add" and user not in pig_vip:
-        pig_vip.append(user)
-        vip_data["PIG"] = pig_vip
+        roster.append(user)
         # 寫回 JSON 檔案
-        with open("pig_vip.json", "w", encoding="utf-8") as f:
-            json.dump(vip_data, f, ensure_ascii=False, indent=4)
+        save_pig_vip(roster)
         return f"✅ 已新增PIG商店會員 **{user}** !"
     elif action == "remove" and user in pig_vip:
-        pig_vip.remove(user)
-        vip_data["PIG"] = pig_vip
+        roster.remove(user)
         # 寫回 JSON 檔案
-        with open("pig_vip.json", "w", encoding="utf-8") as f:
-            json.dump(vip_data, f, ensure_ascii=False, indent=4)
+        save_pig_vip(roster)
         return f"✅ 已移除PIG商店會員 **{user}** !"
     elif action == "list":
-        sanitized = [player.replace('_', '\\_') for player in pig_vip]
+        sanitized = [player.replace('_', '\\_') for player in roster]
         return "🔍 以下為PIG商店會員名單:\n" + "".join(f"**{p}**\n" for p in sanitized)
     else:
         return "❌ 未知指令"